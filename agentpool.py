@@ -0,0 +1,256 @@
+#!/usr/bin/python
+
+"""
+Running the agents' requests() and uploads() calls in worker processes.
+
+Within a phase of a round the agent calls are independent: each only reads
+the round's snapshot and its own state.  AgentPool splits the peers into
+fixed partitions, one per worker, and each worker keeps the agent objects
+of its partition for the whole run, along with its own copies of what
+those agents look at:
+  - the available pieces of every peer, and the PeerInfo snapshot
+  - a RarityIndex of the swarm
+  - a History holding the messages of its own peers
+
+Those are brought up to date at the start of each round from the pieces
+completed in the last one and its downloads and uploads.  Otherwise only
+the agents' own block counts go to the workers, and only the message
+lists (and how long each call took) come back.  Checking the messages
+stays in the sim.
+
+The agents have to be picklable, and must not share state between peers
+(through class attributes, say), since their peers may live in different
+processes.  Each needs its own rng (a seeded run) for the results to be
+reproducible: then they are the same as without the pool.
+"""
+
+import sys
+import logging
+import multiprocessing
+from time import perf_counter
+
+from messages import Request, PeerInfo, PeersView
+from history import History
+from rarity import RarityIndex
+
+
+class Partition:
+    """
+    A worker's side of the pool: the agents of one partition and the
+    copies of the swarm state they see.
+    """
+    def __init__(self, peers, peer_ids, available, upload_rates, num_pieces,
+                 window):
+        """
+        peers: the agent objects of this partition
+        available: dict : peer_id -> set(completed pieces), for every peer
+        """
+        self.peers_by_id = dict((p.id, p) for p in peers)
+        self.available = available
+        self.order = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+        self.peer_info = [PeerInfo(pid, available[pid]) for pid in peer_ids]
+        self.rarity = RarityIndex(num_pieces)
+        for pid in peer_ids:
+            for piece_id in available[pid]:
+                self.rarity.add(pid, piece_id)
+        for p in peers:
+            p.update_rarity(self.rarity.view)
+        # Only this partition's messages are ever filled in
+        self.history = History(peer_ids, upload_rates, window=window)
+        self.no_messages = dict((pid, ()) for pid in peer_ids)
+        self.neighbor_indices = None
+
+    def round_done(self, completed, dls, ups):
+        """
+        completed: [(peer_id, piece_id)] -- the pieces completed in the
+            round, in the order the sim completed them
+        dls, ups: the round's messages for this partition's peers
+        """
+        stale = set()
+        for (peer_id, piece_id) in completed:
+            self.available[peer_id].add(piece_id)
+            self.rarity.add(peer_id, piece_id)
+            stale.add(peer_id)
+        if stale:
+            # A new list, as in the sim, so that views the agents kept from
+            # earlier rounds don't change
+            self.peer_info = list(self.peer_info)
+            for pid in stale:
+                self.peer_info[self.order[pid]] = PeerInfo(pid, self.available[pid])
+        self.history.update(dict(self.no_messages, **dls),
+                            dict(self.no_messages, **ups))
+
+    def set_neighbors(self, neighbor_indices):
+        """neighbor_indices: this partition's entries, as in the sim"""
+        self.neighbor_indices = neighbor_indices
+
+    def visible(self, peer_id):
+        if self.neighbor_indices is not None:
+            return PeersView(self.peer_info,
+                             indices=self.neighbor_indices[peer_id])
+        return PeersView(self.peer_info, skip=self.order[peer_id])
+
+    def requests(self, calls):
+        """
+        calls: [(peer_id, pieces)] -- the peers to ask, with a copy of
+            their block counts
+        Returns [(peer_id, requests, seconds)]
+        """
+        results = []
+        for (peer_id, pieces) in calls:
+            p = self.peers_by_id[peer_id]
+            p.update_pieces(pieces)
+            others = self.visible(peer_id)
+            peer_history = self.history.peer_history(peer_id)
+            start = perf_counter()
+            rs = p.requests(others, peer_history)
+            results.append((peer_id, rs, perf_counter() - start))
+        return results
+
+    def uploads(self, calls):
+        """
+        calls: [(peer_id, rows)] -- the requests made to each peer, as
+            (requester_id, peer_id, piece_id, start) rows
+        Returns [(peer_id, uploads, seconds)]
+        """
+        results = []
+        for (peer_id, rows) in calls:
+            requests = [Request(*row) for row in rows]
+            p = self.peers_by_id[peer_id]
+            others = self.visible(peer_id)
+            peer_history = self.history.peer_history(peer_id)
+            start = perf_counter()
+            us = p.uploads(requests, others, peer_history)
+            results.append((peer_id, us, perf_counter() - start))
+        return results
+
+
+def serve_partition(conn):
+    """
+    A worker: set up a Partition from the first message, then answer
+    ("requests" | "uploads", updates, calls) messages until a None.
+    updates are (method name, args) pairs to apply to the Partition first.
+    """
+    # A forked worker would inherit a running --profile; turn it off
+    sys.setprofile(None)
+    partition = Partition(*conn.recv())
+    while True:
+        msg = conn.recv()
+        if msg is None:
+            break
+        (kind, updates, calls) = msg
+        try:
+            for (method, args) in updates:
+                getattr(partition, method)(*args)
+            conn.send(("ok", getattr(partition, kind)(calls)))
+        except Exception as e:
+            logging.exception("Agent worker failed")
+            conn.send(("error", "%s: %s" % (type(e).__name__, e)))
+    conn.close()
+
+
+class AgentPool:
+    """
+    n worker processes, each owning the agents of every nth peer.
+
+    The sim tells the pool about each round with round_done() and about
+    new neighbors with set_neighbors().  Those are passed on to the workers
+    along with the next calls.
+    """
+    def __init__(self, n, peers, available, upload_rates, num_pieces,
+                 window=None):
+        """
+        peers: all the agent objects, in peer_ids order.  Each worker gets
+            pickled copies of its own, and from then on they live there.
+        available: dict : peer_id -> set(completed pieces) at the start
+        """
+        peer_ids = [p.id for p in peers]
+        self.n = min(n, len(peers))
+        # Every nth peer rather than runs of them, so that each worker gets
+        # a share of every agent class
+        self.worker_of = dict((pid, i % self.n) for (i, pid) in enumerate(peer_ids))
+        self.pending = [[] for w in range(self.n)]
+        self.conns = []
+        self.procs = []
+        for w in range(self.n):
+            (conn, child_conn) = multiprocessing.Pipe()
+            proc = multiprocessing.Process(target=serve_partition,
+                                           args=(child_conn,), daemon=True)
+            proc.start()
+            child_conn.close()
+            conn.send((peers[w::self.n], peer_ids, available, upload_rates,
+                       num_pieces, window))
+            self.conns.append(conn)
+            self.procs.append(proc)
+
+    def _split(self, items):
+        """[(peer_id, ...)] -> one list per worker"""
+        parts = [[] for w in range(self.n)]
+        for item in items:
+            parts[self.worker_of[item[0]]].append(item)
+        return parts
+
+    def _split_dict(self, d):
+        """dict : peer_id -> x -> one dict per worker"""
+        parts = [dict() for w in range(self.n)]
+        for (pid, x) in d.items():
+            parts[self.worker_of[pid]][pid] = x
+        return parts
+
+    def round_done(self, completed, dls, ups):
+        """As Partition.round_done, with the messages of every peer"""
+        completed = list(completed)
+        for (w, (d, u)) in enumerate(zip(self._split_dict(dls),
+                                         self._split_dict(ups))):
+            self.pending[w].append(("round_done", (completed, d, u)))
+
+    def set_neighbors(self, neighbor_indices):
+        for (w, part) in enumerate(self._split_dict(neighbor_indices)):
+            self.pending[w].append(("set_neighbors", (part,)))
+
+    def _call(self, kind, calls):
+        """Fan the calls out, wait for all the workers, and merge"""
+        for (w, part) in enumerate(self._split(calls)):
+            self.conns[w].send((kind, self.pending[w], part))
+            self.pending[w] = []
+        results = dict()
+        errors = []
+        for conn in self.conns:
+            (status, answer) = conn.recv()
+            if status == "ok":
+                for (peer_id, msgs, seconds) in answer:
+                    results[peer_id] = (msgs, seconds)
+            else:
+                errors.append(answer)
+        if errors:
+            raise RuntimeError("Agent worker failed: %s" % errors[0])
+        return results
+
+    def requests(self, calls):
+        """
+        calls: [(peer_id, pieces)]
+        Returns dict : peer_id -> (requests, seconds the call took)
+        """
+        return self._call("requests", calls)
+
+    def uploads(self, calls):
+        """
+        calls: [(peer_id, requests made to it)]
+        Returns dict : peer_id -> (uploads, seconds the call took)
+        """
+        # Every request goes out again here, so they go as plain rows,
+        # which pickle in about half the time
+        rows = [(peer_id, [(r.requester_id, r.peer_id, r.piece_id, r.start)
+                           for r in rs])
+                for (peer_id, rs) in calls]
+        return self._call("uploads", rows)
+
+    def close(self):
+        for conn in self.conns:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+        for proc in self.procs:
+            proc.join()
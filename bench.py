@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks the simulator over a matrix of swarm sizes, file sizes and agent
+mixes.
+
+For every case, Sim.run_sim_once is timed (best of --repeat runs, each with
+the same seed) and then run once more under tracemalloc for its peak memory.
+Results are printed as rounds/sec and peak KB.  --save writes them to a JSON
+baseline; --compare checks them against one and exits with status 1 if any
+case got slower or bigger by more than --threshold.  A baseline is only
+compared against runs with the same engine, rounds, bandwidths and seed.
+"""
+
+import io
+import sys
+import json
+import time
+import logging
+import platform
+import contextlib
+import itertools
+import tracemalloc
+from optparse import OptionParser
+
+from sim import Sim, ENGINES, np, make_config
+from util import load_modules
+
+
+# mix name -> agent classes the leechers are split between.  Every case also
+# gets one seed for every ten peers (at least one).
+MIXES = {
+    "dummy": ["Dummy"],
+    "std": ["DakzStd"],
+    "tyrant": ["DakzTyrant"],
+    "propshare": ["DakzPropShare"],
+    "all": ["Dummy", "DakzStd", "DakzTyrant", "DakzPropShare"],
+}
+
+
+# The options saved with a baseline that change what its numbers mean.  A
+# comparison needs them to match.
+RUN_SETTINGS = ["engine", "max_round", "min_up_bw", "max_up_bw", "seed"]
+
+
+def parse_ints(s):
+    """'10,20,40' -> [10, 20, 40]"""
+    return [int(v) for v in s.split(",")]
+
+
+def agent_names(mix, peers):
+    """One class name per peer: the seeds, then the leechers round-robin"""
+    seeds = max(1, peers // 10)
+    classes = MIXES[mix]
+    leechers = [classes[i % len(classes)] for i in range(peers - seeds)]
+    return ["Seed"] * seeds + sorted(leechers)
+
+
+def case_key(case):
+    return "%(mix)s/peers=%(peers)d/pieces=%(num_pieces)d/bpp=%(blocks_per_piece)d" % case
+
+
+def run_case(case, options, agent_classes):
+    """
+    Returns dict with the rounds played, the best time, rounds_per_sec and
+    peak_kb for one case.
+    """
+    names = agent_names(case["mix"], case["peers"])
+    config = make_config(names, agent_classes,
+                         num_pieces=case["num_pieces"],
+                         blocks_per_piece=case["blocks_per_piece"],
+                         max_round=options.max_round,
+                         min_up_bw=options.min_up_bw,
+                         max_up_bw=options.max_up_bw,
+                         iters=1,
+                         engine=options.engine)
+
+    def run_once():
+        sim = Sim(config, seed=options.seed)
+        # Agents print from post_init(); keep that out of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            history = sim.run_sim_once()
+        return history.num_rounds
+
+    best = None
+    for i in range(options.repeat):
+        start = time.perf_counter()
+        rounds = run_once()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+
+    tracemalloc.start()
+    try:
+        run_once()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {"rounds": rounds,
+            "seconds": best,
+            "rounds_per_sec": rounds / best,
+            "peak_kb": peak / 1024.0}
+
+
+def compare(results, baseline, threshold):
+    """
+    Returns a list of the regression messages: cases whose rounds/sec fell,
+    or whose peak memory grew, by more than threshold (a fraction) against
+    the baseline.  Cases missing from the baseline are skipped.
+    """
+    problems = []
+    for key in sorted(results):
+        if key not in baseline:
+            continue
+        new, old = results[key], baseline[key]
+        if new["rounds_per_sec"] < old["rounds_per_sec"] * (1 - threshold):
+            problems.append("%s: %.1f rounds/sec, baseline %.1f" % (
+                key, new["rounds_per_sec"], old["rounds_per_sec"]))
+        if new["peak_kb"] > old["peak_kb"] * (1 + threshold):
+            problems.append("%s: peak %.0f KB, baseline %.0f KB" % (
+                key, new["peak_kb"], old["peak_kb"]))
+    return problems
+
+
+def setting_mismatches(saved, options):
+    """
+    Returns a message for each of RUN_SETTINGS the baseline was saved
+    with a different value of.  Baselines that don't have a setting saved
+    aren't checked on it.
+    """
+    return ["%s %s, baseline %s" % (name, getattr(options, name), saved[name])
+            for name in RUN_SETTINGS
+            if name in saved and saved[name] != getattr(options, name)]
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options]"
+    parser = OptionParser(usage=usage_msg)
+
+    def usage(msg):
+        print(("Error: %s\n" % msg))
+        parser.print_help()
+        sys.exit()
+
+    parser.add_option("--peers",
+                      dest="peers", default="10,50",
+                      help="Comma-separated swarm sizes")
+
+    parser.add_option("--num-pieces",
+                      dest="num_pieces", default="20,80",
+                      help="Comma-separated numbers of pieces in the file")
+
+    parser.add_option("--blocks-per-piece",
+                      dest="blocks_per_piece", default="4",
+                      help="Comma-separated numbers of blocks per piece")
+
+    parser.add_option("--mixes",
+                      dest="mixes", default=",".join(sorted(MIXES)),
+                      help="Comma-separated agent mixes, from: %s" % ", ".join(sorted(MIXES)))
+
+    parser.add_option("--max-round",
+                      dest="max_round", default=200, type="int",
+                      help="Limit on number of rounds in each run")
+
+    parser.add_option("--min-bw",
+                      dest="min_up_bw", default=4, type="int",
+                      help="Min upload bandwidth")
+
+    parser.add_option("--max-bw",
+                      dest="max_up_bw", default=10, type="int",
+                      help="Max upload bandwidth")
+
+    parser.add_option("--engine",
+                      dest="engine", default="python",
+                      choices=sorted(ENGINES.keys()),
+                      help="How to store the swarm state: 'python' or 'numpy'")
+
+    parser.add_option("--repeat",
+                      dest="repeat", default=3, type="int",
+                      help="Time each case this many times and keep the best")
+
+    parser.add_option("--seed",
+                      dest="seed", default=0, type="int",
+                      help="Seed for every run")
+
+    parser.add_option("--save",
+                      dest="save", default=None,
+                      help="Write the results to this JSON baseline file")
+
+    parser.add_option("--compare",
+                      dest="compare", default=None,
+                      help="Compare the results against this JSON baseline file")
+
+    parser.add_option("--threshold",
+                      dest="threshold", default=0.2, type="float",
+                      help="Fraction of slowdown or memory growth that counts as a regression")
+
+    (options, args) = parser.parse_args()
+
+    mixes = options.mixes.split(",")
+    for mix in mixes:
+        if mix not in MIXES:
+            usage("Unknown mix: %s" % mix)
+    if options.engine == "numpy" and np is None:
+        usage("--engine numpy needs numpy to be installed")
+
+    baseline = None
+    if options.compare:
+        # Check the settings before spending time on the cases
+        with open(options.compare) as f:
+            saved = json.load(f)
+        mismatches = setting_mismatches(saved, options)
+        if mismatches:
+            print("Can't compare against %s, which was run with other settings:"
+                  % options.compare)
+            for m in mismatches:
+                print("  " + m)
+            sys.exit(1)
+        baseline = saved["results"]
+
+    logging.getLogger().setLevel(logging.WARNING)
+    agent_classes = load_modules(sorted(set(
+        itertools.chain(["Seed"], *[MIXES[m] for m in mixes]))))
+
+    cases = [{"mix": mix, "peers": peers, "num_pieces": num_pieces,
+              "blocks_per_piece": bpp}
+             for mix in mixes
+             for peers in parse_ints(options.peers)
+             for num_pieces in parse_ints(options.num_pieces)
+             for bpp in parse_ints(options.blocks_per_piece)]
+
+    results = dict()
+    print("%-45s %7s %12s %10s" % ("case", "rounds", "rounds/sec", "peak KB"))
+    for case in cases:
+        key = case_key(case)
+        results[key] = r = run_case(case, options, agent_classes)
+        print("%-45s %7d %12.1f %10.0f" % (
+            key, r["rounds"], r["rounds_per_sec"], r["peak_kb"]))
+        sys.stdout.flush()
+
+    if options.save:
+        with open(options.save, "w") as f:
+            saved = dict((name, getattr(options, name)) for name in RUN_SETTINGS)
+            saved.update(python=platform.python_version(),
+                         machine=platform.machine(),
+                         results=results)
+            json.dump(saved, f, indent=2, sort_keys=True)
+        print("Saved baseline to %s" % options.save)
+
+    if baseline is not None:
+        problems = compare(results, baseline, options.threshold)
+        if problems:
+            print("Regressions against %s:" % options.compare)
+            for p in problems:
+                print("  " + p)
+            sys.exit(1)
+        print("No regressions against %s" % options.compare)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,158 @@
+#!/usr/bin/python
+
+"""
+On-disk cache of the summaries of seeded simulation runs.
+
+An entry's key is a hash of everything that decides the outcome of one
+iteration: the config settings, the iteration's seed, and the source of
+the agent modules and of the simulator's own modules.  Editing an agent
+only invalidates the runs that use it.  Each entry is a small JSON file
+holding the Stats.summary() of the run.
+"""
+
+import os
+import sys
+import json
+import hashlib
+import logging
+import tempfile
+import importlib.util
+
+# Bump when the summary format or the meaning of a setting changes
+CACHE_VERSION = 1
+
+# Modules that every run depends on, besides the agents'
+SIM_MODULES = ["sim", "history", "messages", "peer", "rarity", "stats", "util",
+               "agentpool"]
+
+# Config settings that don't change the outcome of an iteration.  (The
+# iteration's own seed, derived from "seed", is part of the key.)
+IGNORED_SETTINGS = frozenset(["agent_classes", "iters", "jobs", "agent_jobs",
+                              "seed", "cache_dir", "cache_size", "record"])
+
+# The parts of a run_iteration summary that get cached.  Timings aren't
+# results, so they're left out.
+RESULT_KEYS = ["peer_ids", "rounds", "uploaded_blocks", "downloaded_blocks",
+               "completion_rounds", "all_done_round"]
+
+
+def cacheable(config):
+    """
+    Whether runs with config may be answered from the cache (or added to
+    it).  Not when the run is meant to be watched: logging below WARNING
+    prints every round, and a profiler would only time the cache lookup.
+    Nor when over-budget calls are dropped, which makes the results depend
+    on how fast the machine is.
+    """
+    if logging.getLogger().isEnabledFor(logging.INFO):
+        return False
+    if sys.getprofile() is not None:
+        return False
+    if config.time_budget is not None and config.over_budget == "drop":
+        return False
+    return True
+
+
+def canonical(value):
+    """A JSON-able form of a setting that doesn't depend on set order"""
+    if isinstance(value, (set, frozenset)):
+        return sorted(canonical(v) for v in value)
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if isinstance(value, dict):
+        return dict((str(k), canonical(v)) for (k, v) in value.items())
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    return repr(value)
+
+
+# module name -> digest, for this process
+_digests = dict()
+
+
+def module_digest(module_name):
+    """sha256 of a module's source file"""
+    if module_name not in _digests:
+        # Found by name rather than through sys.modules, which only has sim
+        # as __main__ when it's run as a script
+        path = importlib.util.find_spec(module_name).origin
+        with open(path, "rb") as f:
+            _digests[module_name] = hashlib.sha256(f.read()).hexdigest()
+    return _digests[module_name]
+
+
+class ResultCache:
+    """
+    directory: where the entries live, one file per key
+    max_bytes: once the entries take more than this, the least recently
+        used ones are deleted
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, config, seed):
+        settings = dict((k, canonical(v)) for (k, v) in vars(config).items()
+                        if not k.startswith("_") and k not in IGNORED_SETTINGS)
+        sources = dict((name, module_digest(cls.__module__))
+                       for (name, cls) in config.agent_classes.items())
+        for name in SIM_MODULES:
+            sources[name] = module_digest(name)
+        blob = json.dumps({"version": CACHE_VERSION,
+                           "settings": settings,
+                           "seed": str(seed),
+                           "sources": sources}, sort_keys=True)
+        return hashlib.sha256(blob.encode()).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        """The cached summary for key, or None"""
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                summary = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Mark it as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return summary
+
+    def put(self, key, summary):
+        entry = dict((k, summary[k]) for k in RESULT_KEYS)
+        # Write to a temporary file and rename, so that readers never see
+        # half an entry
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f, separators=(",", ":"))
+        os.replace(tmp, self._path(key))
+
+    def evict(self):
+        """Delete the least recently used entries until under max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        entries.sort()
+        for (mtime, size, path) in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+        logging.debug("Result cache: %d bytes in %s", total, self.directory)
@@ -6,7 +6,6 @@
 # You'll want to copy this file to AgentNameXXX.py for various versions of XXX,
 # probably get rid of the silly logging messages, and then add more logic.
 
-import random
 import logging
 
 from messages import Upload, Request
@@ -32,42 +31,34 @@ class DakzTourney(Peer):
         np_set = set(needed_pieces)  # sets support fast intersection ops.
 
 
-        logging.debug("%s here: still need pieces %s" % (
-            self.id, needed_pieces))
+        logging.debug("%s here: still need pieces %s",
+                      self.id, needed_pieces)
 
-        logging.debug("%s still here. Here are some peers:" % self.id)
-        for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("%s still here. Here are some peers:", self.id)
+            for p in peers:
+                logging.debug("id: %s, available pieces: %s",
+                              p.id, p.available_pieces)
 
         logging.debug("And look, I have my entire history available too:")
         logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        logging.debug("%s", history)
 
         requests = []
+        peer_ids = set(p.id for p in peers)
 
-        # Sorted list of the rarest pieces and the peers that have them
-        piece_dict = {}
-        for peer in peers:
-            av_set = set(peer.available_pieces)
-            for piece in av_set:
-                piece_dict.setdefault(piece, [])
-                piece_dict[piece].append(peer.id)
-        avail_set = set(piece_dict.keys())
-        # Rarest order is a list of tuples with the rarest pieces first
-        # and the peers that have the corresponding piece
-        rarest_order = []
-        for k in sorted(piece_dict, key=lambda k: len(piece_dict[k]), reverse=False):
-            rarest_order.append((k, piece_dict[k]))
-        
-        isect = np_set.intersection(avail_set)
+        # The sim keeps the rarity index for the whole swarm, so the pieces
+        # anyone has available come already sorted with the rarest first
         # in order of piece rarity, request the piece from all players that have it
-        for item in rarest_order:
-            if item[0] in isect:
-                start_block = self.pieces[item[0]]
-                while len(item[1]) != 0:
-                    req_peer = random.choice(item[1])
-                    r = Request(self.id, req_peer, item[0], start_block)
-                    item[1].remove(req_peer)
+        for piece_id in self.rarity.rarest_order():
+            if piece_id in np_set:
+                start_block = self.pieces[piece_id]
+                # Only the peers we can see can be asked (see --tracker-k)
+                holders = sorted(self.rarity.holders(piece_id) & peer_ids)
+                while len(holders) != 0:
+                    req_peer = self.rng.choice(holders)
+                    r = Request(self.id, req_peer, piece_id, start_block)
+                    holders.remove(req_peer)
                     requests.append(r)
         return requests
 
@@ -83,8 +74,7 @@ class DakzTourney(Peer):
         """
 
         round = history.current_round()
-        logging.debug("%s again.  It's round %d." % (
-            self.id, round))
+        logging.debug("%s again.  It's round %d.", self.id, round)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
@@ -96,7 +86,7 @@ class DakzTourney(Peer):
 
         for request in requests:
             requester_id_list.append(request.requester_id)
-        random.shuffle(requester_id_list)
+        self.rng.shuffle(requester_id_list)
 
         if len(requests) == 0:
             logging.debug("No one wants my pieces!")
@@ -130,14 +120,14 @@ class DakzTourney(Peer):
                     if uploaded == 3:
                         break
                 while uploaded < 3:
-                    rand_req = random.choice(requester_id_list)
+                    rand_req = self.rng.choice(requester_id_list)
                     uploads.append(Upload(self.id, rand_req, bws[uploaded]))
                     requester_id_list.remove(rand_req)
                     uploaded += 1
                 
                 if round % 1 == 0 and round != 0:
                     if len(requester_id_list) != 0:
-                        opt_unchoke = random.choice(requester_id_list)
+                        opt_unchoke = self.rng.choice(requester_id_list)
                         self.dummy_state["unchoke"] = opt_unchoke
                 if round >= 1 and ("unchoke" in self.dummy_state) and (self.dummy_state["unchoke"] in requester_id_list):
                     uploads.append(Upload(self.id, self.dummy_state["unchoke"], bws[3]))                        
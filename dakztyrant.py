@@ -36,42 +36,34 @@ class DakzTyrant(Peer):
         np_set = set(needed_pieces)  # sets support fast intersection ops.
 
 
-        logging.debug("%s here: still need pieces %s" % (
-            self.id, needed_pieces))
+        logging.debug("%s here: still need pieces %s",
+                      self.id, needed_pieces)
 
-        logging.debug("%s still here. Here are some peers:" % self.id)
-        for p in peers:
-            logging.debug("id: %s, available pieces: %s" % (p.id, p.available_pieces))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("%s still here. Here are some peers:", self.id)
+            for p in peers:
+                logging.debug("id: %s, available pieces: %s",
+                              p.id, p.available_pieces)
 
         logging.debug("And look, I have my entire history available too:")
         logging.debug("look at the AgentHistory class in history.py for details")
-        logging.debug(str(history))
+        logging.debug("%s", history)
 
         requests = []
+        peer_ids = set(p.id for p in peers)
 
-        # Sorted list of the rarest pieces and the peers that have them
-        piece_dict = {}
-        for peer in peers:
-            av_set = set(peer.available_pieces)
-            for piece in av_set:
-                piece_dict.setdefault(piece, [])
-                piece_dict[piece].append(peer.id)
-        avail_set = set(piece_dict.keys())
-        # Rarest order is a list of tuples with the rarest pieces first
-        # and the peers that have the corresponding piece
-        rarest_order = []
-        for k in sorted(piece_dict, key=lambda k: len(piece_dict[k]), reverse=False):
-            rarest_order.append((k, piece_dict[k]))
-        
-        isect = np_set.intersection(avail_set)
+        # The sim keeps the rarity index for the whole swarm, so the pieces
+        # anyone has available come already sorted with the rarest first
         # in order of piece rarity, request the piece from all players that have it
-        for item in rarest_order:
-            if item[0] in isect:
-                start_block = self.pieces[item[0]]
-                while len(item[1]) != 0:
-                    req_peer = random.choice(item[1])
-                    r = Request(self.id, req_peer, item[0], start_block)
-                    item[1].remove(req_peer)
+        for piece_id in self.rarity.rarest_order():
+            if piece_id in np_set:
+                start_block = self.pieces[piece_id]
+                # Only the peers we can see can be asked (see --tracker-k)
+                holders = sorted(self.rarity.holders(piece_id) & peer_ids)
+                while len(holders) != 0:
+                    req_peer = self.rng.choice(holders)
+                    r = Request(self.id, req_peer, piece_id, start_block)
+                    holders.remove(req_peer)
                     requests.append(r)
         return requests
 
@@ -87,8 +79,7 @@ class DakzTyrant(Peer):
         """
 
         round = history.current_round()
-        logging.debug("%s again.  It's round %d." % (
-            self.id, round))
+        logging.debug("%s again.  It's round %d.", self.id, round)
         # One could look at other stuff in the history too here.
         # For example, history.downloads[round-1] (if round != 0, of course)
         # has a list of Download objects for each Download to this peer in
@@ -97,8 +88,10 @@ class DakzTyrant(Peer):
         uploads = []
         request_ids = [r.requester_id for r in requests]
 
-        if round == 0:
-            for j in peers:
+        # Start estimates for peers the first time we see them: everyone in
+        # round 0, and new neighbors later on in tracker mode
+        for j in peers:
+            if j.id not in self.uij:
                 self.uij[j.id] = self.up_bw / 4
                 self.dij[j.id] = len(j.available_pieces) / 4
                 self.unchoked_me[j.id] = 0
@@ -129,7 +122,7 @@ class DakzTyrant(Peer):
                 for id in self.rates:
                     if self.rates[id] == max_rate:
                         max_ids.append(id)
-                to_upload = random.choice(max_ids)
+                to_upload = self.rng.choice(max_ids)
                 
                 if cap - self.uij[to_upload] > 0 and to_upload in request_ids:
                     i_unchoked.append(to_upload)
@@ -2,6 +2,52 @@
 
 import copy
 import pprint
+from array import array
+
+from messages import Download, Upload
+
+# The smallest history window a run of the bundled agents can use: DakzStd
+# and DakzTourney look back two rounds (history.downloads[round-2]).
+MIN_WINDOW = 2
+
+
+class RoundsView:
+    """
+    Read-only, list-like view of one peer's messages in a History: one list
+    of message objects per round.  Supports len(), iteration and indexing by
+    round (negative indices and slices too, as for a list).  The message
+    objects are rebuilt from the History's columns on access.
+    """
+    def __init__(self, history, kind, peer_index):
+        self._history = history
+        self._kind = kind
+        self._peer_index = peer_index
+
+    def __len__(self):
+        return self._history.num_rounds
+
+    def __getitem__(self, r):
+        if isinstance(r, slice):
+            return [self[i] for i in range(*r.indices(len(self)))]
+        if r < 0:
+            r += len(self)
+        if r < 0 or r >= len(self):
+            raise IndexError("round index out of range")
+        return self._history.messages(self._kind, r, self._peer_index)
+
+    def __iter__(self):
+        for r in range(len(self)):
+            yield self[r]
+
+    def kept(self):
+        """
+        The rounds still held in memory, as a list: all of them, unless the
+        History has a window.
+        """
+        return self[self._history.first_round:]
+
+    def __repr__(self):
+        return repr(self.kept())
 
 
 class AgentHistory:
@@ -14,6 +60,9 @@ class AgentHistory:
     history.uploads: [[Upload objects for round]]  (one sublist for each round)
          All the downloads _from_ this agent.
 
+    Both are RoundsViews onto the sim's History: they index and iterate like
+    the lists above, but can't be modified.
+
     """
     def __init__(self, peer_id, downloads, uploads):
         """
@@ -32,28 +81,80 @@ class AgentHistory:
 
     def __repr__(self):
         return "AgentHistory(downloads=%s, uploads=%s)" % (
-            pprint.pformat(self.downloads),
-            pprint.pformat(self.uploads))
+            pprint.pformat(self.downloads.kept()),
+            pprint.pformat(self.uploads.kept()))
 
 
 class History:
-    """History of the whole sim"""
-    def __init__(self, peer_ids, upload_rates):
+    """
+    History of the whole sim, stored column-wise.
+
+    Every Download is one row of the parallel download columns
+    (dl_round, dl_from, dl_to, dl_piece, dl_blocks), and every Upload one
+    row of the upload columns (up_round, up_from, up_to, up_bw).  Rows are
+    appended in round order, and within a round in peer_ids order, grouped by
+    the peer that downloaded / uploaded.  Aggregate queries are scans over
+    these columns.
+
+    With a window of W rounds, only the most recent W or so rounds are
+    kept in the columns: once 2W are held, the oldest are dropped down to
+    W, so the last W full rounds are always there.  Memory then stays
+    bounded however long the run.  The views still
+    count every round, but indexing a dropped one raises IndexError.  The
+    running totals cover all rounds either way.
+
+    A sink, if given, is passed every round and finished peer as they
+    come in (see record.Recorder).
+    """
+    def __init__(self, peer_ids, upload_rates, window=None, sink=None):
         """
         uploads:
-                   dict : peer_id -> [[uploads] -- one list per round]
+                   dict : peer_id -> RoundsView of [[uploads] -- one list per round]
         downloads:
-                   dict : peer_id -> [[downloads] -- one list per round]
+                   dict : peer_id -> RoundsView of [[downloads] -- one list per round]
                    
         Keep track of the uploads _from_ and downloads _to_ the
         specified peer id.
         """
+        if window is not None and window < 1:
+            raise ValueError("History window must be at least 1 round, not %s"
+                             % window)
         self.upload_rates = upload_rates  # peer_id -> up_bw
         self.peer_ids = peer_ids[:]
 
         self.round_done = dict()   # peer_id -> round finished
-        self.downloads = dict((pid, []) for pid in peer_ids)
-        self.uploads = dict((pid, []) for pid in peer_ids)
+        self.num_rounds = 0
+        self.window = window
+        self.sink = sink
+        self.first_round = 0  # earlier rounds were dropped (see window)
+
+        # Running totals, kept current by update() and peer_is_done(), so
+        # stats can be read cheaply at any point of a run
+        self.uploaded = dict((pid, 0) for pid in peer_ids)    # blocks sent
+        self.downloaded = dict((pid, 0) for pid in peer_ids)  # blocks received
+        self.round_blocks = []   # total blocks downloaded, one per round
+        self.round_bw = []       # total upload bw offered, one per round
+
+        self.dl_round = array('l')
+        self.dl_from = []
+        self.dl_to = []
+        self.dl_piece = array('l')
+        self.dl_blocks = []   # ints, unless an agent uploaded fractional bw
+
+        self.up_round = array('l')
+        self.up_from = []
+        self.up_to = []
+        self.up_bw = []
+
+        # The rows for peer i in round r are offsets[k] : offsets[k + 1],
+        # k = (r - first_round)*P + i, with P peers.
+        self._offsets = {"downloads": array('l', [0]),
+                         "uploads": array('l', [0])}
+
+        self.downloads = dict((pid, RoundsView(self, "downloads", i))
+                              for (i, pid) in enumerate(self.peer_ids))
+        self.uploads = dict((pid, RoundsView(self, "uploads", i))
+                            for (i, pid) in enumerate(self.peer_ids))
 
     def update(self, dls, ups):
         """
@@ -62,43 +163,111 @@ class History:
 
         append these downloads to to the history
         """
+        r = self.num_rounds
+        dl_offsets = self._offsets["downloads"]
+        up_offsets = self._offsets["uploads"]
+        round_blocks = 0
+        round_bw = 0
         for pid in self.peer_ids:
-            self.downloads[pid].append(dls[pid])
-            self.uploads[pid].append(ups[pid])
+            for d in dls[pid]:
+                self.dl_round.append(r)
+                self.dl_from.append(d.from_id)
+                self.dl_to.append(d.to_id)
+                self.dl_piece.append(d.piece)
+                self.dl_blocks.append(d.blocks)
+                self.uploaded[d.from_id] += d.blocks
+                self.downloaded[pid] += d.blocks
+                round_blocks += d.blocks
+            dl_offsets.append(len(self.dl_round))
+            for u in ups[pid]:
+                self.up_round.append(r)
+                self.up_from.append(u.from_id)
+                self.up_to.append(u.to_id)
+                self.up_bw.append(u.bw)
+                round_bw += u.bw
+            up_offsets.append(len(self.up_round))
+        self.round_blocks.append(round_blocks)
+        self.round_bw.append(round_bw)
+        self.num_rounds += 1
+        if self.sink is not None:
+            self.sink.write_round(r, dls, ups)
+        if self.window is not None:
+            self._trim()
+
+    def _trim(self):
+        """Drop the oldest rounds, down to the window, once 2x are held"""
+        held = self.num_rounds - self.first_round
+        if held < 2 * self.window:
+            return
+        drop = held - self.window
+        first_index = drop * len(self.peer_ids)
+        columns = {"downloads": [self.dl_round, self.dl_from, self.dl_to,
+                                 self.dl_piece, self.dl_blocks],
+                   "uploads": [self.up_round, self.up_from, self.up_to,
+                               self.up_bw]}
+        for (kind, cols) in columns.items():
+            offsets = self._offsets[kind]
+            rows = offsets[first_index]
+            for col in cols:
+                del col[:rows]
+            self._offsets[kind] = array('l', (o - rows for o in
+                                              offsets[first_index:]))
+        self.first_round += drop
+
+    def messages(self, kind, r, peer_index):
+        """
+        kind: "downloads" or "uploads"
+        Returns the list of message objects for that peer in round r.
+        """
+        if r < self.first_round:
+            raise IndexError("round %d was dropped from the history "
+                             "(window of %d rounds)" % (r, self.window))
+        offsets = self._offsets[kind]
+        i = (r - self.first_round) * len(self.peer_ids) + peer_index
+        rows = range(offsets[i], offsets[i + 1])
+        if kind == "downloads":
+            return [Download(self.dl_from[j], self.dl_to[j],
+                             self.dl_piece[j], self.dl_blocks[j])
+                    for j in rows]
+        return [Upload(self.up_from[j], self.up_to[j], self.up_bw[j])
+                for j in rows]
+
+    def uploaded_blocks(self):
+        """dict : peer_id -> total blocks other peers downloaded from it"""
+        return dict(self.uploaded)
 
     def peer_is_done(self, round, peer_id):
         # Only save the _first_ round where we hear this
         if peer_id not in self.round_done:
             self.round_done[peer_id] = round
+            if self.sink is not None:
+                self.sink.write_done(round, peer_id)
 
     def peer_history(self, peer_id):
         return AgentHistory(peer_id, self.downloads[peer_id], self.uploads[peer_id])
 
     def last_round(self):
         """index of the last completed round"""
-        p = self.peer_ids[0]
-        return len(self.downloads[p])-1
+        return self.num_rounds-1
 
     def pretty_for_round(self, r):
-        s = "\nRound %s:\n" % r
+        lines = ["\nRound %s:\n" % r]
         for peer_id in self.peer_ids:
-            ds = self.downloads[peer_id][r]
-            stringify = lambda d: "%s downloaded %d blocks of piece %d from %s\n" % (
-                peer_id, d.blocks, d.piece, d.from_id)
-            s += "".join(map(stringify, ds))
-        return s
+            for d in self.downloads[peer_id][r]:
+                lines.append("%s downloaded %d blocks of piece %d from %s\n" % (
+                    peer_id, d.blocks, d.piece, d.from_id))
+        return "".join(lines)
 
     def pretty(self):
-        s = "History\n"
-        for r in range(self.last_round()+1):
-            s += self.pretty_for_round(r)
-        return s
+        return "History\n" + "".join(self.pretty_for_round(r)
+                                      for r in range(self.first_round,
+                                                     self.last_round()+1))
 
     def __repr__(self):
         return """History(
 uploads=%s
 downloads=%s
 )""" % (
-    pprint.pformat(self.uploads),
-    pprint.pformat(self.downloads))
+    pprint.pformat(dict((pid, v.kept()) for (pid, v) in self.uploads.items())),
+    pprint.pformat(dict((pid, v.kept()) for (pid, v) in self.downloads.items())))
 
@@ -1,22 +1,43 @@
 #!/usr/bin/python
 
+import itertools
+from collections.abc import MutableSequence
+
+# Messages are created by the thousands every round, and History keeps every
+# Download and Upload for the whole run, so they use __slots__ rather than a
+# per-instance __dict__.  Attribute names and reprs are unchanged.  They
+# pickle as their constructor call (__reduce__), which is a lot quicker than
+# the default for __slots__ classes; agentpool.py sends them between
+# processes every round.
+
 class Upload:
+    __slots__ = ("from_id", "to_id", "bw")
+
     def __init__(self, from_id, to_id, up_bw):
         self.from_id = from_id
         self.to_id = to_id
         self.bw = up_bw
 
+    def __reduce__(self):
+        return (Upload, (self.from_id, self.to_id, self.bw))
+
     def __repr__(self):
         return "Upload(from_id = %s, to_id=%s, bw=%d)" % (
             self.from_id, self.to_id, self.bw)
 
 class Request:
+    __slots__ = ("requester_id", "peer_id", "piece_id", "start")
+
     def __init__(self, requester_id, peer_id, piece_id, start):
         self.requester_id = requester_id
         self.peer_id = peer_id   # peer data is requested from
         self.piece_id = piece_id
         self.start = start  # the block index
 
+    def __reduce__(self):
+        return (Request, (self.requester_id, self.peer_id, self.piece_id,
+                          self.start))
+
     def __repr__(self):
         return "Request(requester_id=%s, peer_id=%s, piece_id=%d, start=%d)" % (
             self.requester_id, self.peer_id, self.piece_id, self.start)
@@ -25,12 +46,17 @@ class Download:
     """ Not actually a message--just used for accounting and history tracking of
      what is actually downloaded.
     """
+    __slots__ = ("from_id", "to_id", "piece", "blocks")
+
     def __init__(self, from_id, to_id, piece, blocks):
         self.from_id = from_id  # who did the agent download from?
         self.to_id = to_id      # Who downloaded?
         self.piece = piece      # Which piece?
         self.blocks = blocks    # How much did the agent download?
 
+    def __reduce__(self):
+        return (Download, (self.from_id, self.to_id, self.piece, self.blocks))
+
     def __repr__(self):
         return "Download(from_id=%s, to_id=%s, piece=%d, blocks=%d)" % (
             self.from_id, self.to_id, self.piece, self.blocks)
@@ -41,12 +67,137 @@ class Download:
 class PeerInfo:
     """
     Only passing peer ids and the pieces they have available to each agent.
-    This prevents them from accidentally messing up the state of other agents.
+    This prevents them from accidentally messing up the state of other agents:
+    available_pieces is a frozenset, and a PeerInfo can't be changed once
+    made.  The sim shares one PeerInfo per peer between all the agents for
+    as long as that peer's pieces don't change.
     """
+    __slots__ = ("id", "available_pieces")
+
     def __init__(self, id, available):
-        self.id = id
-        self.available_pieces = available
+        object.__setattr__(self, "id", id)
+        object.__setattr__(self, "available_pieces", frozenset(available))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("PeerInfo is read-only")
+
+    def __delattr__(self, name):
+        raise AttributeError("PeerInfo is read-only")
+
+    def __reduce__(self):
+        # The default would set the slots one by one, which __setattr__
+        # refuses, so pickle and copy go through the constructor instead
+        return (PeerInfo, (self.id, self.available_pieces))
 
     def __repr__(self):
         return "PeerInfo(id=%s)" % self.id
 
+
+class PeersView(MutableSequence):
+    """
+    The PeerInfo an agent can see in a round, as a sequence over the
+    round's shared snapshot (a list of PeerInfo, one per peer) rather than
+    a copy of it.  It holds either every peer but the one at index skip,
+    or just the ones at indices.
+
+    It works like a list.  Reading it copies nothing.  The first change
+    (sort(), random.shuffle(), remove(), pop(), append(), item assignment
+    and so on) takes a private copy, so an agent can change its view
+    without touching anyone else's.  copy() and copy.copy() give a new
+    view with its own copy, if any.
+    """
+    __slots__ = ("_snapshot", "_skip", "_indices", "_items")
+
+    def __init__(self, snapshot, skip=None, indices=None):
+        self._snapshot = snapshot
+        self._skip = skip
+        self._indices = indices
+        self._items = None  # the private copy, once changed
+
+    def __len__(self):
+        if self._items is not None:
+            return len(self._items)
+        if self._indices is not None:
+            return len(self._indices)
+        return len(self._snapshot) - 1
+
+    def __getitem__(self, i):
+        if self._items is not None:
+            return self._items[i]
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError("PeersView index out of range")
+        if self._indices is not None:
+            return self._snapshot[self._indices[i]]
+        return self._snapshot[i if i < self._skip else i + 1]
+
+    def __iter__(self):
+        # Iterate in C, without building a list
+        if self._items is not None:
+            return iter(self._items)
+        if self._indices is not None:
+            return map(self._snapshot.__getitem__, self._indices)
+        return itertools.chain(
+            itertools.islice(self._snapshot, self._skip),
+            itertools.islice(self._snapshot, self._skip + 1, None))
+
+    def _own(self):
+        """The private copy, taken on the first change"""
+        if self._items is None:
+            self._items = list(self)
+        return self._items
+
+    def __setitem__(self, i, value):
+        self._own()[i] = value
+
+    def __delitem__(self, i):
+        del self._own()[i]
+
+    def insert(self, i, value):
+        self._own().insert(i, value)
+
+    def sort(self, key=None, reverse=False):
+        self._own().sort(key=key, reverse=reverse)
+
+    def reverse(self):
+        self._own().reverse()
+
+    def __copy__(self):
+        view = PeersView(self._snapshot, self._skip, self._indices)
+        if self._items is not None:
+            view._items = list(self._items)
+        return view
+
+    copy = __copy__
+
+    # As for a list, + and * make new lists, and a view equals any list
+    # (or view) with the same PeerInfo in the same order
+    def __add__(self, other):
+        if isinstance(other, PeersView):
+            other = list(other)
+        return list(self) + other
+
+    def __radd__(self, other):
+        return other + list(self)
+
+    def __mul__(self, n):
+        return list(self) * n
+
+    __rmul__ = __mul__
+
+    def __imul__(self, n):
+        self._own()[:] = self._own() * n
+        return self
+
+    def __eq__(self, other):
+        if isinstance(other, (list, PeersView)):
+            return len(self) == len(other) and list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(list(self))
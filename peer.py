@@ -5,12 +5,18 @@ from messages import Upload, Request
 from util import even_split
 
 class Peer:
-    def __init__(self, config, id, init_pieces, up_bandwidth):
+    def __init__(self, config, id, init_pieces, up_bandwidth, rng=None):
         self.conf = config
         self.id = id
+        # Source of randomness for this peer's decisions: use self.rng.choice
+        # etc. rather than the random module, so that seeded runs (--seed)
+        # can be reproduced.  Without a seed it is the random module itself.
+        self.rng = random if rng is None else rng
         self.pieces = init_pieces[:]
         # bandwidth measured in blocks-per-time-period
         self.up_bw = round(up_bandwidth)
+        # Set by the sim before the first round -- see update_rarity()
+        self.rarity = None
 
         # This is an upper bound on the number of requests to send to
         # each peer -- they can't possibly handle more than this in one round
@@ -31,6 +37,13 @@ class Peer:
         """
         self.pieces = new_pieces
 
+    def update_rarity(self, rarity):
+        """
+        Called by the sim once per simulation with a read-only RarityView of
+        the whole swarm.  The sim keeps it current from round to round.
+        """
+        self.rarity = rarity
+
     def requests(self, peers, history):
         return []
 
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+
+class RarityIndex:
+    """
+    Who holds each piece of the file, maintained by the sim.
+
+    holders_by_piece: [set(peer ids)] -- one set per piece
+    by_count: dict : holder count -> set(piece ids)
+
+    The sim calls add() whenever a peer completes a piece, so keeping the
+    index current costs time proportional to the pieces that changed hands
+    in a round, not to the size of the swarm.  Agents only ever see the
+    read-only RarityView in self.view.
+    """
+    def __init__(self, num_pieces):
+        self.holders_by_piece = [set() for i in range(num_pieces)]
+        self.by_count = {0: set(range(num_pieces))}
+        # Caches handed out to agents.  Dropped as soon as they go stale.
+        self._frozen_holders = dict()  # piece_id -> frozenset(peer ids)
+        self._rarest_order = None
+        self.view = RarityView(self)
+
+    def add(self, peer_id, piece_id):
+        """Record that peer_id now has all of piece_id."""
+        holders = self.holders_by_piece[piece_id]
+        if peer_id in holders:
+            return
+        old_count = len(holders)
+        holders.add(peer_id)
+
+        bucket = self.by_count[old_count]
+        bucket.discard(piece_id)
+        if not bucket:
+            del self.by_count[old_count]
+        self.by_count.setdefault(old_count + 1, set()).add(piece_id)
+
+        self._frozen_holders.pop(piece_id, None)
+        self._rarest_order = None
+
+    def count(self, piece_id):
+        return len(self.holders_by_piece[piece_id])
+
+    def holders(self, piece_id):
+        if piece_id not in self._frozen_holders:
+            self._frozen_holders[piece_id] = frozenset(
+                self.holders_by_piece[piece_id])
+        return self._frozen_holders[piece_id]
+
+    def rarest_order(self):
+        """
+        Tuple of the piece ids held by at least one peer, fewest holders
+        first.  Ties are broken by piece id.  Rebuilt at most once per round,
+        and only if some piece changed hands.
+        """
+        if self._rarest_order is None:
+            order = []
+            for c in sorted(self.by_count):
+                if c > 0:
+                    order.extend(sorted(self.by_count[c]))
+            self._rarest_order = tuple(order)
+        return self._rarest_order
+
+
+class RarityView:
+    """
+    Read-only window onto a RarityIndex, handed to every agent.
+
+    rarity.count(piece_id): number of peers that have the whole piece
+    rarity.holders(piece_id): frozenset of the ids of those peers
+    rarity.rarest_order(): tuple of available piece ids, rarest first
+
+    The counts include every peer in the swarm -- the agent itself too, for
+    pieces it has already finished.
+    """
+    def __init__(self, index):
+        self._index = index
+
+    def count(self, piece_id):
+        return self._index.count(piece_id)
+
+    def holders(self, piece_id):
+        return self._index.holders(piece_id)
+
+    def rarest_order(self):
+        return self._index.rarest_order()
+
+    def __repr__(self):
+        return "RarityView(rarest_order=%s)" % (self.rarest_order(),)
@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+"""
+Recording a run's history to disk as it happens.
+
+A recording is a gzipped JSON-lines file.  Each line is one record, a
+dict with a "type":
+  header -- written first: peer_ids, agent_class_names, upload_rates,
+            seeds (the peers that start with every piece), the config
+            settings and the seed
+  round  -- one per round: "downloads" and "uploads", each a dict : peer_id
+            -> list of rows, for the peers that had any.  A download row
+            is [from_id, to_id, piece, blocks] and an upload row
+            [from_id, to_id, bw].
+  done   -- a peer finished: "round" and "peer_id"
+  end    -- written last, with the number of rounds played
+
+Lines are written as the sim goes, so nothing has to be kept in memory to
+produce the file.  A recording without an end record is from a run that
+didn't finish.  read_records() streams them back.
+"""
+
+import gzip
+import json
+
+RECORD_VERSION = 1
+
+
+def record_path(path, iteration, iters):
+    """
+    Where iteration should be recorded, for a --record path: path itself
+    for a single iteration, else with the iteration number added before
+    the extension (run.jsonl.gz -> run.3.jsonl.gz).
+    """
+    if iters == 1:
+        return path
+    if path.endswith(".jsonl.gz"):
+        return "%s.%d.jsonl.gz" % (path[:-len(".jsonl.gz")], iteration)
+    return "%s.%d" % (path, iteration)
+
+
+class Recorder:
+    """
+    A History sink (see History) that writes the rounds to a recording.
+    """
+    def __init__(self, path, header):
+        """
+        header: dict of the header fields
+        """
+        self.path = path
+        self.f = gzip.open(path, "wt", compresslevel=6)
+        self.rounds = 0
+        fields = {"type": "header", "version": RECORD_VERSION}
+        fields.update(header)
+        self._write(fields)
+
+    def _write(self, record):
+        self.f.write(json.dumps(record, separators=(",", ":")))
+        self.f.write("\n")
+
+    def write_round(self, r, dls, ups):
+        """dls, ups: as for History.update()"""
+        downloads = dict((pid, [[d.from_id, d.to_id, d.piece, d.blocks]
+                                for d in ds])
+                         for (pid, ds) in dls.items() if ds)
+        uploads = dict((pid, [[u.from_id, u.to_id, u.bw] for u in us])
+                       for (pid, us) in ups.items() if us)
+        self._write({"type": "round", "round": r,
+                     "downloads": downloads, "uploads": uploads})
+        self.rounds = r + 1
+
+    def write_done(self, r, peer_id):
+        self._write({"type": "done", "round": r, "peer_id": peer_id})
+
+    def close(self):
+        if self.f is None:
+            return
+        self._write({"type": "end", "rounds": self.rounds})
+        self.f.close()
+        self.f = None
+
+
+def read_records(path):
+    """Generator of the records in a recording, in order"""
+    with gzip.open(path, "rt") as f:
+        for line in f:
+            yield json.loads(line)
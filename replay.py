@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+"""
+Recomputes the stats of a recorded run (see sim.py --record) without
+running any agents.
+
+The recording is streamed round by round into a History, so the usual
+Stats come out the same as for the original run, and a few more analyses
+are made on the way:
+  - upload totals per agent class
+  - rarity over time: how many peers hold each piece, round by round
+  - reciprocity: how much of what each peer uploaded went to peers that
+    uploaded back to it
+"""
+
+import sys
+import logging
+from optparse import OptionParser
+
+from messages import Download, Upload
+from history import History
+from stats import Stats
+from rarity import RarityIndex
+from record import read_records
+from util import mean
+
+
+class RarityOverTime:
+    """
+    Tracks which peers hold which pieces, from the downloads, and samples
+    the holder counts of the pieces after every round.
+
+    samples: list of (min, mean, max) holders per piece, one per round
+    """
+    def __init__(self, header):
+        conf = header["config"]
+        self.blocks_per_piece = conf["blocks_per_piece"]
+        self.num_pieces = conf["num_pieces"]
+        self.rarity = RarityIndex(self.num_pieces)
+        for pid in header["seeds"]:
+            for piece_id in range(self.num_pieces):
+                self.rarity.add(pid, piece_id)
+        self.blocks = dict()  # (peer_id, piece_id) -> blocks so far
+        self.samples = []
+
+    def round(self, record):
+        for (pid, rows) in record["downloads"].items():
+            for (from_id, to_id, piece_id, blocks) in rows:
+                key = (pid, piece_id)
+                self.blocks[key] = self.blocks.get(key, 0) + blocks
+                if self.blocks[key] >= self.blocks_per_piece:
+                    self.rarity.add(pid, piece_id)
+        counts = [self.rarity.count(i) for i in range(self.num_pieces)]
+        self.samples.append((min(counts), mean(counts), max(counts)))
+
+    def report(self, every):
+        lines = ["round: holders per piece min / mean / max"]
+        last = len(self.samples) - 1
+        for (r, (lo, avg, hi)) in enumerate(self.samples):
+            if r % every == 0 or r == last:
+                lines.append("%d: %d / %.1f / %d" % (r, lo, avg, hi))
+        return lines
+
+
+class Reciprocity:
+    """
+    Sums up the blocks that went between every pair of peers.  A peer's
+    reciprocity is the share of the blocks it uploaded that it got back
+    from the same peers: sum over j of min(i -> j, j -> i), over i's
+    total upload.
+    """
+    def __init__(self, header):
+        self.peer_ids = header["peer_ids"]
+        self.flows = dict()  # (from_id, to_id) -> blocks
+
+    def round(self, record):
+        for rows in record["downloads"].values():
+            for (from_id, to_id, piece_id, blocks) in rows:
+                key = (from_id, to_id)
+                self.flows[key] = self.flows.get(key, 0) + blocks
+
+    def by_peer(self):
+        """dict : peer_id -> reciprocity, or None if it uploaded nothing"""
+        sent = dict((pid, 0) for pid in self.peer_ids)
+        returned = dict((pid, 0) for pid in self.peer_ids)
+        for ((i, j), blocks) in self.flows.items():
+            sent[i] += blocks
+            returned[i] += min(blocks, self.flows.get((j, i), 0))
+        return dict((pid, returned[pid] / float(sent[pid]) if sent[pid] else None)
+                    for pid in self.peer_ids)
+
+
+def replay(path, window=None, analyses=()):
+    """
+    Stream the recording at path into a History, handing every round
+    record to each of the analyses after the History has it.
+
+    analyses: classes made with the header record, with a round(record)
+        method, like RarityOverTime
+
+    Returns (header, history, analyses, complete): analyses are the
+    instances, and complete says whether the recording has its end record.
+    """
+    records = read_records(path)
+    header = next(records)
+    if header["type"] != "header":
+        raise ValueError("%s doesn't start with a header record" % path)
+    peer_ids = header["peer_ids"]
+    history = History(peer_ids, header["upload_rates"], window=window)
+    analyses = [cls(header) for cls in analyses]
+    complete = False
+    for record in records:
+        kind = record["type"]
+        if kind == "round":
+            downloads = record["downloads"]
+            uploads = record["uploads"]
+            dls = dict((pid, [Download(*row) for row in downloads.get(pid, [])])
+                       for pid in peer_ids)
+            ups = dict((pid, [Upload(*row) for row in uploads.get(pid, [])])
+                       for pid in peer_ids)
+            history.update(dls, ups)
+            for analysis in analyses:
+                analysis.round(record)
+        elif kind == "done":
+            history.peer_is_done(record["round"], record["peer_id"])
+        elif kind == "end":
+            complete = True
+    return header, history, analyses, complete
+
+
+def class_uploads(header, history):
+    """dict : agent class -> (peers, total blocks uploaded)"""
+    totals = dict()
+    for (pid, name) in zip(header["peer_ids"], header["agent_class_names"]):
+        peers, blocks = totals.get(name, (0, 0))
+        totals[name] = (peers + 1, blocks + history.uploaded[pid])
+    return totals
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options] RECORDING"
+    parser = OptionParser(usage=usage_msg)
+
+    def usage(msg):
+        print(("Error: %s\n" % msg))
+        parser.print_help()
+        sys.exit()
+
+    parser.add_option("--every",
+                      dest="every", default=None, type="int",
+                      help="Show rarity every this many rounds (default: about 20 lines)")
+
+    parser.add_option("--history-window",
+                      dest="history_window", default=None, type="int",
+                      help="Only keep the messages of about this many recent rounds in memory")
+
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        usage("Give exactly one recording")
+    if options.history_window is not None and options.history_window < 1:
+        usage("--history-window must be at least 1")
+
+    header, history, analyses, complete = replay(
+        args[0], options.history_window, [RarityOverTime, Reciprocity])
+    rarity, reciprocity = analyses
+    peer_ids = header["peer_ids"]
+    if not complete:
+        logging.warning("%s has no end record; the run didn't finish", args[0])
+
+    names = header["agent_class_names"]
+    agents = " ".join("%s,%d" % (name, names.count(name))
+                      for name in sorted(set(names), key=names.index))
+    print("Replayed %d rounds of %s (seed %s)" % (
+        history.num_rounds, agents, header["seed"]))
+
+    print("\nUploaded blocks:")
+    print(Stats.uploaded_blocks_str(peer_ids, history))
+    print("\nCompletion rounds:")
+    print(Stats.completion_rounds_str(peer_ids, history))
+    print("\nAll done round: %s" % Stats.all_done_round(peer_ids, history))
+
+    print("\nUploaded blocks by agent class: peers, total (per peer)")
+    for (name, (peers, blocks)) in sorted(class_uploads(header, history).items()):
+        print("%s: %d, %.1f  (%.1f)" % (name, peers, blocks, blocks / float(peers)))
+
+    print("\nRarity over time")
+    every = options.every or max(1, history.num_rounds // 20)
+    for line in rarity.report(every):
+        print(line)
+
+    print("\nReciprocity: share of uploaded blocks that came back")
+    by_peer = reciprocity.by_peer()
+    for pid in peer_ids:
+        r = by_peer[pid]
+        print("%s: %s" % (pid, "-" if r is None else "%.2f" % r))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -15,17 +15,264 @@ import logging
 import copy
 import itertools
 import pprint
+import multiprocessing
+from time import perf_counter
 from optparse import OptionParser
 
-from messages import Upload, Request, Download, PeerInfo
+from messages import Upload, Request, Download, PeerInfo, PeersView
 from util import *
 from stats import Stats
-from history import History
-    
+from history import History, MIN_WINDOW
+from rarity import RarityIndex
+from timers import PhaseTimers, CallLatencies
+from cache import ResultCache, cacheable, canonical
+from record import Recorder, record_path
+from agentpool import AgentPool
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class PythonEngine:
+    """
+    Swarm state kept in plain python structures.
+
+    blocks: dict : peer_id -> [blocks / piece]
+    available: dict : peer_id -> set(completed pieces)
+
+    The sets in available are the ones handed to agents through PeerInfo.
+
+    Completion is tracked incrementally: missing counts the pieces each peer
+    doesn't have all the blocks of yet, and unfinished holds the peers with
+    anything missing.  Both are updated by apply(), so checking whether a
+    peer or the whole swarm is done is O(1).
+    """
+    def __init__(self, conf, peer_ids, peer_pieces):
+        """peer_pieces: dict : peer_id -> [blocks / piece] at the start"""
+        self.conf = conf
+        self.peer_ids = peer_ids
+        self.blocks = peer_pieces
+        self.available = dict(
+            (pid, set(i for i in range(conf.num_pieces)
+                      if peer_pieces[pid][i] == conf.blocks_per_piece))
+            for pid in peer_ids)
+        self.missing = dict(
+            (pid, sum(1 for b in peer_pieces[pid] if b < conf.blocks_per_piece))
+            for pid in peer_ids)
+        self._init_done()
+
+    def _init_done(self):
+        self.index = dict((pid, i) for (i, pid) in enumerate(self.peer_ids))
+        self.unfinished = set(pid for pid in self.peer_ids
+                              if self.missing[pid] > 0)
+        # Peers that finished since the last newly_done() call
+        self._newly_done = [pid for pid in self.peer_ids
+                            if pid not in self.unfinished]
+
+    def _finished(self, peer_id):
+        self.unfinished.discard(peer_id)
+        self._newly_done.append(peer_id)
+
+    def pieces(self, peer_id):
+        """A fresh copy of the peer's block counts, safe to give to its agent"""
+        return copy.copy(self.blocks[peer_id])
+
+    def block_counts(self, peer_id):
+        """
+        The peer's block counts, for the sim to read (not to give to
+        agents): as pieces(), but maybe not a copy
+        """
+        return self.blocks[peer_id]
+
+    def apply(self, gains):
+        """
+        gains: [(peer_id, piece_id, blocks)] -- at most one entry per
+        (peer_id, piece_id) pair.
+
+        Add the blocks and return the list of (peer_id, piece_id) pairs
+        that were completed by them.
+        """
+        bpp = self.conf.blocks_per_piece
+        completed = []
+        for (peer_id, piece_id, blocks) in gains:
+            pieces = self.blocks[peer_id]
+            was_missing = pieces[piece_id] < bpp
+            pieces[piece_id] += blocks
+            if pieces[piece_id] == bpp:
+                self.available[peer_id].add(piece_id)
+                completed.append((peer_id, piece_id))
+            if was_missing and pieces[piece_id] >= bpp:
+                self.missing[peer_id] -= 1
+                if self.missing[peer_id] == 0:
+                    self._finished(peer_id)
+        return completed
+
+    def peer_done(self, peer_id):
+        return peer_id not in self.unfinished
+
+    def all_done(self):
+        return len(self.unfinished) == 0
+
+    def newly_done(self):
+        """
+        The ids of the peers that got the whole file since the last call, in
+        peer_ids order.  The first call also returns the peers that started
+        with it.
+        """
+        done = sorted(self._newly_done, key=self.index.__getitem__)
+        self._newly_done = []
+        return done
+
+    def completed_counts(self):
+        """dict : peer_id -> number of completed pieces"""
+        return dict((pid, len(self.available[pid])) for pid in self.peer_ids)
+
+    def allocate(self, requests, rates):
+        """
+        Work out what the uploads bought each requester.
+
+        requests: dict : requester_id -> [Request]
+        rates: dict : requester_id -> {uploader_id: bw}
+
+        The bandwidth an uploader gives a requester is spent on the
+        requester's requests to it in order, each getting as many blocks as
+        it still needs, until the bandwidth runs out.  Asking several peers
+        for the same piece doesn't stack: only the largest share counts,
+        the first uploader (by id) winning ties.
+
+        Returns [(requester_id, piece_id, blocks, uploader_id)], the pieces
+        of each requester in the order they were first given blocks.
+        """
+        bpp = self.conf.blocks_per_piece
+        allocs = []
+        get_peer_id = lambda r: r.peer_id
+        for (requester_id, rs) in requests.items():
+            rates_to = rates.get(requester_id)
+            if not rs or not rates_to:
+                continue
+            # Requests to peers that aren't uploading to this requester get
+            # nothing, so only the rest need sorting
+            rs = [r for r in rs if r.peer_id in rates_to]
+            got = dict()  # piece -> (blocks, from_who)
+            uploader_id = None
+            for r in sorted(rs, key=get_peer_id):
+                if r.peer_id != uploader_id:
+                    uploader_id = r.peer_id
+                    bw = rates_to[uploader_id]
+                if bw == 0:
+                    continue
+                blocks = min(bw, bpp - r.start)
+                bw -= blocks
+                old = got.get(r.piece_id)
+                if old is None or blocks > old[0]:
+                    got[r.piece_id] = (blocks, uploader_id)
+            allocs.extend((requester_id, piece_id, blocks, uploader_id)
+                          for (piece_id, (blocks, uploader_id)) in got.items())
+        return allocs
+
+
+class NumpyEngine(PythonEngine):
+    """
+    Swarm state kept in numpy arrays, for large files and swarms.
+
+    blocks: 2-D array -- one row of block counts per peer, in peer_ids order
+    done: 2-D boolean array -- completed pieces, same shape as blocks
+    available: dict : peer_id -> set(completed pieces), as for PythonEngine
+
+    Blocks are counted in integers.  Agents may hand out fractional
+    bandwidth though, so the first fractional gain switches the counts to
+    floats rather than truncating it.  floats then marks the counts that
+    have had a float added, which the python engine would hold as floats;
+    pieces() gives the rest as ints, as it would.
+    """
+    def __init__(self, conf, peer_ids, peer_pieces):
+        self.conf = conf
+        self.peer_ids = peer_ids
+        self.row = dict((pid, i) for (i, pid) in enumerate(peer_ids))
+        self.blocks = np.array([peer_pieces[pid] for pid in peer_ids],
+                               dtype=np.int64)
+        self.blocks.shape = (len(peer_ids), conf.num_pieces)
+        self.done = self.blocks == conf.blocks_per_piece
+        self.available = dict((pid, set(np.flatnonzero(self.done[i]).tolist()))
+                              for (i, pid) in enumerate(peer_ids))
+        self.missing = (self.blocks < conf.blocks_per_piece).sum(axis=1)
+        self.unfinished = set(self.peer_ids[i]
+                              for i in np.flatnonzero(self.missing).tolist())
+        self.index = self.row
+        self.floats = None
+        self._newly_done = [pid for pid in peer_ids
+                            if pid not in self.unfinished]
+
+    def pieces(self, peer_id):
+        i = self.row[peer_id]
+        if self.floats is None:
+            return self.blocks[i].tolist()
+        counts = self.blocks[i].astype(np.int64).tolist()
+        for j in np.flatnonzero(self.floats[i]).tolist():
+            counts[j] = self.blocks[i, j].item()
+        return counts
+
+    def block_counts(self, peer_id):
+        # The values are all the checks need, int or float
+        return self.blocks[self.row[peer_id]].tolist()
+
+    def apply(self, gains):
+        if len(gains) == 0:
+            return []
+        peer_ids, piece_ids, blocks = list(zip(*gains))
+        rows = np.fromiter((self.row[pid] for pid in peer_ids),
+                           dtype=np.intp, count=len(peer_ids))
+        cols = np.array(piece_ids, dtype=np.intp)
+        gained = blocks
+        blocks = np.array(blocks)
+        if blocks.dtype.kind == 'f':
+            if self.floats is None:
+                self.blocks = self.blocks.astype(np.float64)
+                self.floats = np.zeros(self.blocks.shape, dtype=bool)
+            is_float = np.fromiter((isinstance(b, float) for b in gained),
+                                   dtype=bool, count=len(gained))
+            self.floats[rows[is_float], cols[is_float]] = True
+        bpp = self.conf.blocks_per_piece
+        # (row, col) pairs are unique, so plain fancy indexing is enough
+        was_missing = self.blocks[rows, cols] < bpp
+        self.blocks[rows, cols] += blocks
+        now = self.blocks[rows, cols]
+        newly = (now == bpp) & ~self.done[rows, cols]
+        self.done[rows[newly], cols[newly]] = True
+        completed = []
+        for i in np.flatnonzero(newly).tolist():
+            self.available[peer_ids[i]].add(piece_ids[i])
+            completed.append((peer_ids[i], piece_ids[i]))
+
+        crossed = rows[was_missing & (now >= bpp)]
+        if len(crossed):
+            np.subtract.at(self.missing, crossed, 1)
+            for i in np.unique(crossed[self.missing[crossed] == 0]).tolist():
+                self._finished(self.peer_ids[i])
+        return completed
+
+    def completed_counts(self):
+        return dict(zip(self.peer_ids, self.done.sum(axis=1).tolist()))
+
+
+ENGINES = {"python": PythonEngine, "numpy": NumpyEngine}
+
 
 class Sim:
-    def __init__(self, config):
+    def __init__(self, config, seed=None, record=None):
+        """
+        seed: if given, the sim draws from its own random.Random(seed), and
+            each peer gets a random.Random seeded from seed and its id.
+            Otherwise everything uses the random module.
+        record: if given, a path to record the run's history to, as it
+            happens (see record.py)
+        """
         self.config = config
+        self.seed = seed
+        self.record = record
+        self.rng = random if seed is None else random.Random(seed)
         self.up_bws_state = dict()
 
     
@@ -38,114 +285,103 @@ class Sim:
         if reinit and peer_id in s:
             del s[peer_id]
         
+        # Only draw a bandwidth the first time, so that looking it up again
+        # (e.g. in check_uploads) doesn't use up random numbers
+        if peer_id in s:
+            return s[peer_id]
+
         """Sets the upload bandwidth of seeds to max, other agents at random"""
         if re.match("Seed",peer_id): the_up_bw = c.max_up_bw
-        else: the_up_bw = random.randint(c.min_up_bw, c.max_up_bw)
+        else: the_up_bw = self.rng.randint(c.min_up_bw, c.max_up_bw)
         
         return s.setdefault(peer_id, the_up_bw)
 
     def run_sim_once(self):
         """Return a history"""
         conf = self.config
+        if conf.agent_jobs > 1 and self.seed is None:
+            raise ValueError("agent_jobs > 1 needs a seeded Sim, so that "
+                             "every agent has its own rng")
         # Keep track of the current round.  Needs to be in scope for helpers.
         round = 0  
 
-        def check_pred(pred, msg, Exc, lst):
-            """Check if any element of lst matches the predicate.  If it does,
-            raise an exception of type Exc, including the msg and the offending
-            element."""
-            m = list(map(pred, lst))
-            if True in m:
-                i = m.index(True)
-                raise Exc(msg + " Bad element: %s" % lst[i])
+        # Each check makes a single pass over the agent's messages and stops
+        # at the first bad one.  The checks for each message run in the
+        # order below, and the error names the first one it fails.
 
         def check_uploads(peer, uploads):
             """Raise an IllegalUpload exception if there is a problem."""
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalUpload, uploads)
-
-            not_upload = lambda o: not isinstance(o, Upload)
-            check(not_upload, "List of Uploads contains non-Upload object.")
-
-            self_upload = lambda upload: upload.to_id == peer.id
-            check(self_upload, "Can't upload to yourself.")
-            
-            not_from_self = lambda upload: upload.from_id != peer.id
-            check(not_from_self, "Upload.from != peer id.")
-
-            check(lambda u: u.bw < 0, "Upload bandwidth must be non-negative!")
+            total = 0
+            for u in uploads:
+                if not isinstance(u, Upload):
+                    msg = "List of Uploads contains non-Upload object."
+                elif u.to_id == peer.id:
+                    msg = "Can't upload to yourself."
+                elif u.from_id != peer.id:
+                    msg = "Upload.from != peer id."
+                elif u.bw < 0:
+                    msg = "Upload bandwidth must be non-negative!"
+                else:
+                    total += u.bw
+                    continue
+                raise IllegalUpload(msg + " Bad element: %s" % u)
 
             limit = self.up_bw(peer.id)
-            if sum([u.bw for u in uploads]) > limit:
+            if total > limit:
                 raise IllegalUpload("Can't upload more than limit of %d. Attempted to upload %s, for uploads: %s" % (
-                    limit, sum([u.bw for u in uploads])), uploads)
+                    limit, total, uploads))
 
             # If we got here, looks ok.
 
-        def check_requests(peer, requests, peer_pieces, available):
+        def check_requests(peer, requests, state):
             """Raise an IllegalRequest exception if there is a problem."""
-
-            def check(pred, msg):
-                check_pred(pred, msg, IllegalRequest, requests)
-
-            check(lambda o: not isinstance(o, Request),
-                  "List of Requests contains non-Request object.")
-
-            bad_piece_id = lambda r: (r.piece_id < 0 or
-                                      r.piece_id >= self.config.num_pieces)
-            check(bad_piece_id, "Request asks for non-existent piece!")
-            
-            bad_peer_id = lambda r: r.peer_id not in self.peer_ids
-            check(bad_peer_id, "Request mentions non-existent peer!")
-
-            bad_requester_id = lambda r: r.requester_id != peer.id
-            check(bad_requester_id, "Request has wrong peer id!")
-
-            bad_start_block = lambda r: (
-                r.start < 0 or
-                r.start >= self.config.blocks_per_piece or
-                r.start > peer_pieces[peer.id][r.piece_id])
-            # Must request the _next_ necessary block
-            check(bad_start_block, "Request has bad start block!")
-
-            def piece_peer_does_not_have(r):
-                other_peer = self.peers_by_id[r.peer_id]
-                return r.piece_id not in available[other_peer.id]
-            check(piece_peer_does_not_have, "Asking for piece peer does not have!")
+            num_pieces = self.config.num_pieces
+            blocks_per_piece = self.config.blocks_per_piece
+            # One lookup for the whole list
+            blocks = state.block_counts(peer.id)
+            for r in requests:
+                if not isinstance(r, Request):
+                    msg = "List of Requests contains non-Request object."
+                elif r.piece_id < 0 or r.piece_id >= num_pieces:
+                    msg = "Request asks for non-existent piece!"
+                elif r.peer_id not in self.peers_by_id:
+                    msg = "Request mentions non-existent peer!"
+                elif r.requester_id != peer.id:
+                    msg = "Request has wrong peer id!"
+                elif (r.start < 0 or
+                      r.start >= blocks_per_piece or
+                      r.start > blocks[r.piece_id]):
+                    # Must request the _next_ necessary block
+                    msg = "Request has bad start block!"
+                elif r.piece_id not in state.available[r.peer_id]:
+                    msg = "Asking for piece peer does not have!"
+                elif neighbors is not None and r.peer_id not in neighbors[peer.id]:
+                    msg = "Request asks a peer that isn't a neighbor!"
+                else:
+                    continue
+                raise IllegalRequest(msg + " Bad element: %s" % r)
             
             # If we got here, looks ok
 
-        def available_pieces(peer_id, peer_pieces):
-            """
-            Return a list of piece ids that this peer has available.
-            """
-            return [i for i in range(conf.num_pieces) if peer_pieces[peer_id][i] == conf.blocks_per_piece]
-
-        def peer_done(peer_pieces, peer_id):
-            # TODO: remove linear pass
-            for blocks_so_far in peer_pieces[peer_id]:
-                if blocks_so_far < conf.blocks_per_piece:
-                    return False
-            return True
-            
-        def all_done(peer_pieces):
-            result = True
-            # Check all peers to update done status
-            for peer_id in peer_pieces:
-                if peer_done(peer_pieces, peer_id):
-                    history.peer_is_done(round, peer_id)
-                else:
-                    result = False
-            return result
+        def all_done(state):
+            # Only the peers that finished this round need recording
+            for peer_id in state.newly_done():
+                history.peer_is_done(round, peer_id)
+            return state.all_done()
 
         def create_peers():
             """Each agent class must be already loaded, and have a
             constructor that takes the config, id,  pieces, and
-            up and down bandwidth, in that order."""
+            up and down bandwidth, in that order.  In a seeded run it also
+            gets its own random.Random as the rng keyword argument."""
 
             def load(class_name, params):
                 agent_class = conf.agent_classes[class_name]
-                return agent_class(*params)
+                if self.seed is None:
+                    return agent_class(*params)
+                peer_id = params[1]
+                rng = random.Random("%s:%s" % (self.seed, peer_id))
+                return agent_class(*params, rng=rng)
 
             counts = dict()
             def index(name):
@@ -182,173 +418,387 @@ class Sim:
             #logging.debug("Peers: \n" + "\n".join(str(p) for p in peers))
             return peers, peer_pieces
 
-        def get_peer_requests(p, peer_info, peer_history, peer_pieces, available):
-            def remove_me(info):
-                # TODO: Do we need this linear pass?
-                return [peer for peer in peer_info if peer.id != p.id]
+        def within_budget(p, method, seconds, result):
+            """
+            Record how long p's requests() or uploads() call took.  Returns
+            the call's result, or [] if it went over conf.time_budget and
+            the policy is to drop it.
+            """
+            class_name = p.__class__.__name__
+            latencies.add(class_name, method, seconds)
+            budget = conf.time_budget
+            if budget is None or seconds <= budget:
+                return result
+            latencies.add_over_budget(class_name, method)
+            if conf.over_budget == "drop":
+                logging.warning("%s.%s() took %.3fs, over the %.3fs budget; "
+                                "ignoring its result", p.id, method,
+                                seconds, budget)
+                return []
+            logging.warning("%s.%s() took %.3fs, over the %.3fs budget",
+                            p.id, method, seconds, budget)
+            return result
+
+        def visible(p, peer_info):
+            """
+            The PeerInfo of the peers p can see: its neighbors in tracker
+            mode, else everyone but itself.  A view onto the round's
+            snapshot, so nothing is copied, and the agent can't change it.
+            """
+            if neighbors is not None:
+                return PeersView(peer_info, indices=neighbor_indices[p.id])
+            return PeersView(peer_info, skip=order[p.id])
 
-            pieces = copy.copy(peer_pieces[p.id])
+        def sample_neighbors():
+            """
+            A tracker announce for every peer: returns dict : peer_id ->
+            set(neighbor ids), with up to conf.tracker_k random neighbors
+            each.  Links go both ways, so i sees j exactly when j sees i.
+            O(peers * k).
+            """
+            ids = self.peer_ids
+            k = min(conf.tracker_k, len(ids) - 1)
+            nbrs = dict((pid, set()) for pid in ids)
+            for pid in ids:
+                mine = nbrs[pid]
+                tries = 0
+                # Give up on a peer after a few misses, which only happen
+                # once most of the others are full
+                while len(mine) < k and tries < 4 * k:
+                    tries += 1
+                    other = ids[self.rng.randrange(len(ids))]
+                    if other == pid or other in mine or len(nbrs[other]) >= k:
+                        continue
+                    mine.add(other)
+                    nbrs[other].add(pid)
+            return nbrs
+
+        def get_peer_requests(p, peer_info, peer_history, state):
+            pieces = state.pieces(p.id)
             # Made copy of pieces and the peer info this peer needs to make it's
             # decision, so that it can't change the simulation's copies.
             p.update_pieces(pieces)
-            rs = p.requests(remove_me(peer_info), peer_history)
-            check_requests(p, rs, peer_pieces, available)
+            others = visible(p, peer_info)
+            start = perf_counter()
+            rs = p.requests(others, peer_history)
+            return checked_requests(p, rs, perf_counter() - start, state)
+
+        def checked_requests(p, rs, seconds, state):
+            """The requests p made in seconds, once through the checks"""
+            rs = within_budget(p, "requests", seconds, rs)
+            if p.id not in trusted:
+                start = perf_counter()
+                check_requests(p, rs, state)
+                timers.add("validation", perf_counter() - start)
             return rs
 
-        def get_peer_uploads(all_requests, p, peer_info, peer_history):
-            def remove_me(info):
-                # TODO: remove this pass?  Use a set?
-                return [peer for peer in peer_info if peer.id != p.id]
-
-            def requests_to(id):
-                f = lambda r: r.peer_id == id
-                ans = []
-                for rs in list(all_requests.values()):
-                    ans.extend(list(filter(f, rs)))
-                return ans
-
-            requests = requests_to(p.id)
-
-            us = p.uploads(requests, remove_me(peer_info), peer_history)
-            check_uploads(p, us)
+        def get_peer_uploads(requests, p, peer_info, peer_history):
+            """requests: the requests made to p this round"""
+            others = visible(p, peer_info)
+            start = perf_counter()
+            us = p.uploads(requests, others, peer_history)
+            return checked_uploads(p, us, perf_counter() - start)
+
+        def checked_uploads(p, us, seconds):
+            """The uploads p made in seconds, once through the checks"""
+            us = within_budget(p, "uploads", seconds, us)
+            if p.id not in trusted:
+                start = perf_counter()
+                check_uploads(p, us)
+                timers.add("validation", perf_counter() - start)
             return us
 
-        def upload_rate(uploads, uploader_id, requester_id):
+        def requests_by_target(requests):
             """
-            return the uploading rate from uploader to requester
-            in blocks per time period, or 0 if not uploading.
+            Bucket all of this round's requests by the peer they are made to,
+            in a single pass.  Each bucket keeps the order the requests were
+            made in.
             """
-            for u in uploads[uploader_id]:
-                if u.to_id == requester_id:
-                    return u.bw
-            return 0
+            by_target = dict((pid, []) for pid in self.peer_ids)
+            for rs in requests.values():
+                for r in rs:
+                    by_target[r.peer_id].append(r)
+            return by_target
 
-        def update_peer_pieces(peer_pieces, requests, uploads, available):
+        def update_peer_pieces(state, requests, uploads, rarity):
             """
             Process the uploads: figure out how many blocks of all the requested
-            pieces the requesters ended up with.
-            Make sure requesting the same thing from lots of peers doesn't
-            stack.
-            update the sets of available pieces as needed.
+            pieces the requesters ended up with (see state.allocate()).
+            update the sets of available pieces and the rarity index as needed.
+
+            The state is updated in place, touching only the entries that
+            actually got blocks, and all in one state.apply() batch at the
+            end.  That is safe because agents only ever see copies of their
+            own block counts (see get_peer_requests), and this runs after
+            every agent has made its decisions for the round, so no agent can
+            observe a partly applied update.
+
+            Returns dict : peer_id -> [downloads] for this round
             """
+            # requester -> {uploader: bw}.  If an uploader lists a requester
+            # more than once, the first upload counts.
+            rates = dict()
+            for (uploader_id, us) in uploads.items():
+                for u in us:
+                    rates_to = rates.setdefault(u.to_id, dict())
+                    if uploader_id not in rates_to:
+                        rates_to[uploader_id] = u.bw
+
             downloads = dict()  # peer_id -> [downloads]
-            new_pp = copy.deepcopy(peer_pieces)
             for requester_id in requests:
                 downloads[requester_id] = list()
-            for requester_id in requests:
-                # Keep track of how many blocks of each piece this
-                # requester got.  piece -> (blocks, from_who)
-                new_blocks_per_piece = dict()
-                def update_count(piece_id, blocks, peer_id):
-                    if piece_id in new_blocks_per_piece:
-                        old = new_blocks_per_piece[piece_id][0]
-                        if blocks > old:
-                            new_blocks_per_piece[piece_id] = (blocks, peer_id)
-                    else:
-                        new_blocks_per_piece[piece_id] = (blocks, peer_id)
-
-                # Group the requests by peer that is being asked
-                get_peer_id = lambda r: r.peer_id
-                rs = sorted(requests[requester_id], key=get_peer_id)
-                for peer_id, rs_for_peer in itertools.groupby(rs, get_peer_id):
-                    bw = upload_rate(uploads, peer_id, requester_id)
-                    if bw == 0:
-                        continue
-                    # This bandwidth gets applied in order to each piece requested
-                    for r in rs_for_peer:
-                        needed_blocks = conf.blocks_per_piece - r.start
-                        alloced_bw = min(bw, needed_blocks)
-                        update_count(r.piece_id, alloced_bw, peer_id)
-                        bw -= alloced_bw
-                        if bw == 0:
-                            break
-                for piece_id in new_blocks_per_piece:
-                    (blocks, peer_id) = new_blocks_per_piece[piece_id]
-                    new_pp[requester_id][piece_id] += blocks
-                    if new_pp[requester_id][piece_id] == conf.blocks_per_piece:
-                        available[requester_id].add(piece_id)
-                    d = Download(peer_id, requester_id, piece_id, blocks)
-                    downloads[requester_id].append(d)
-                
-            return (new_pp, downloads)
-
-        def completed_pieces(peer_id, available):
-            return len(available[peer_id])
-        
-        def log_peer_info(peer_pieces, available):
-            for p_id in self.peer_ids:
-                pieces = peer_pieces[p_id]
-                logging.debug("pieces for %s: %s" % (str(p_id), str(pieces)))
-            log = ", ".join("%s:%s" % (p_id, completed_pieces(p_id, available))
-                            for p_id in self.peer_ids)
-            logging.info("Pieces completed: " + log)
-
-
-        logging.debug("Starting simulation with config: %s" % str(conf))
+            gains = []  # (peer_id, piece_id, blocks)
+            for (requester_id, piece_id, blocks, uploader_id) in state.allocate(requests, rates):
+                gains.append((requester_id, piece_id, blocks))
+                d = Download(uploader_id, requester_id, piece_id, blocks)
+                downloads[requester_id].append(d)
+
+            for (peer_id, piece_id) in state.apply(gains):
+                rarity.add(peer_id, piece_id)
+                stale.add(peer_id)
+                completed.append((peer_id, piece_id))
+            return downloads
+
+        def log_peer_info(state):
+            # Only build the strings when they are going to be printed
+            if log_debug:
+                for p_id in self.peer_ids:
+                    logging.debug("pieces for %s: %s", p_id, state.pieces(p_id))
+            if log_info:
+                completed = state.completed_counts()
+                log = ", ".join("%s:%s" % (p_id, completed[p_id])
+                                for p_id in self.peer_ids)
+                logging.info("Pieces completed: %s", log)
+
+
+        # The level can't change during a run, so check it once
+        log_debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+        log_info = logging.getLogger().isEnabledFor(logging.INFO)
+
+        logging.debug("Starting simulation with config: %s", conf)
 
         peers, peer_pieces = create_peers()
         self.peer_ids = [p.id for p in peers]
         self.peers_by_id = dict((p.id, p) for p in peers)
+        # Peers whose agent class is vetted, so their messages aren't checked
+        trusted = set(p.id for p in peers
+                      if p.__class__.__name__ in conf.trusted_agents)
         
         upload_rates = dict((id, self.up_bw(id)) for id in self.peer_ids)
-        history = History(self.peer_ids, upload_rates)
-
-        # dict : pid -> set(finished / available pieces)
-        available = dict((pid, set(available_pieces(pid, peer_pieces)))
-                         for pid in self.peer_ids)
+        recorder = None
+        if self.record is not None:
+            recorder = Recorder(self.record, {
+                "peer_ids": self.peer_ids,
+                "agent_class_names": list(conf.agent_class_names),
+                "upload_rates": upload_rates,
+                # peers that start with the whole file
+                "seeds": [pid for pid in self.peer_ids
+                          if min(peer_pieces[pid]) == conf.blocks_per_piece],
+                "config": dict((k, canonical(v)) for (k, v) in vars(conf).items()
+                               if not k.startswith("_") and k != "agent_classes"),
+                "seed": self.seed})
+        history = History(self.peer_ids, upload_rates,
+                          window=conf.history_window, sink=recorder)
+        # The run in progress -- Stats.summary(sim.peer_ids, sim.history)
+        # gives live numbers while it runs
+        self.history = history
+
+        # Block counts and finished / available pieces for every peer
+        state = ENGINES[conf.engine](conf, self.peer_ids, peer_pieces)
+        available = state.available  # dict : pid -> set(available pieces)
+
+        # With conf.agent_jobs > 1, the agents' requests() and uploads() run
+        # in that many worker processes (see agentpool.py).  The workers get
+        # their own copies of the agents here, before the sim hands them its
+        # rarity index, and from then on only those copies are called.
+        agent_pool = None
+        if conf.agent_jobs > 1:
+            agent_pool = AgentPool(conf.agent_jobs, peers, available,
+                                   upload_rates, conf.num_pieces,
+                                   conf.history_window)
+
+        # piece -> holders, kept up to date by update_peer_pieces
+        rarity = RarityIndex(conf.num_pieces)
+        for pid in self.peer_ids:
+            for piece_id in available[pid]:
+                rarity.add(pid, piece_id)
+        for p in peers:
+            p.update_rarity(rarity.view)
+
+        # Time spent in each phase of the round loop
+        timers = PhaseTimers()
+        self.phase_times = timers
+        # How long each agent's requests() and uploads() calls take
+        latencies = CallLatencies()
+        self.call_latencies = latencies
+
+        # With conf.active_set, agents that have nothing to do in a round
+        # aren't called:
+        #  - a finished peer gets update_pieces() and requests() once more,
+        #    to see its last pieces, and from then on makes no requests
+        #  - uploads() isn't called for a peer that nobody asked for blocks
+        #    if it is finished or made no requests itself
+        # Round 0 calls everyone, so that agents can set themselves up, and
+        # so does every tracker announce, when peers get new neighbors to
+        # set up for.  Otherwise the bundled agents draw no random numbers
+        # and change no state when they have nothing to do, so the results
+        # are the same.
+        active_set = conf.active_set
+        synced = set()  # finished peers that have seen their last pieces
+
+        # What the agents see of each other: one immutable PeerInfo per
+        # peer, in peer_ids order.  Each round gets its own snapshot list,
+        # with new PeerInfo only for the peers that completed pieces.
+        order = dict((pid, i) for (i, pid) in enumerate(self.peer_ids))
+        peer_info = [PeerInfo(p.id, available[p.id]) for p in peers]
+        stale = set()  # peers that completed pieces since the last snapshot
+        completed = []  # (peer_id, piece_id) completed this round, in order
+
+        # In tracker mode (conf.tracker_k set) each peer only sees, and can
+        # only request from, a random set of neighbors, resampled every
+        # conf.tracker_interval rounds.  Nothing in a round then costs
+        # O(peers^2).
+        tracker = conf.tracker_k is not None
+        neighbors = None         # peer_id -> set(neighbor ids)
+        neighbor_indices = None  # peer_id -> sorted tuple of their indices
 
         # Begin the event loop
-        while True:
-            logging.info("======= Round %d ========" % round)
-
-            peer_info = [PeerInfo(p.id, available[p.id])
-                         for p in peers]
-            requests = dict()  # peer_id -> list of Requests
-            uploads = dict()   # peer_id -> list of Uploads
-            h = dict()
-            for p in peers:
-                h[p.id] = history.peer_history(p.id)
-                requests[p.id] = get_peer_requests(p, peer_info, h[p.id], peer_pieces,
-                                                   available)
-
-            for p in peers:
-                uploads[p.id] = get_peer_uploads(requests, p, peer_info, h[p.id])
-                
-
-            (peer_pieces, downloads) = update_peer_pieces(
-                peer_pieces, requests, uploads, available)
-            history.update(downloads, uploads)
-
-            logging.debug(history.pretty_for_round(round))
-
-            log_peer_info(peer_pieces, available)
-           
-            if all_done(peer_pieces):
-                logging.info("All done!")                    
-                break
-            round += 1
-            if round > conf.max_round:
-                logging.info("Out of time.  Stopping.")
-                break
-
-        logging.info("Game history:\n%s" % history.pretty())
-
-        logging.info("======== STATS ========")
-        logging.info("Uploaded blocks:\n%s" %
-                     Stats.uploaded_blocks_str(self.peer_ids, history))
-        logging.info("Completion rounds:\n%s" %
-                     Stats.completion_rounds_str(self.peer_ids, history))
-        logging.info("All done round: %s" %
-                     Stats.all_done_round(self.peer_ids, history))
-
+        timers.start()
+        try:
+            while True:
+                logging.info("======= Round %d ========", round)
+                timers.lap("logging")
+
+                # Whether the active set calls every agent this round
+                everyone = round == 0
+                if tracker and round % conf.tracker_interval == 0:
+                    everyone = True
+                    neighbors = sample_neighbors()
+                    # In peer_ids order, as the full view would be
+                    neighbor_indices = dict(
+                        (pid, tuple(sorted(order[n] for n in nbrs)))
+                        for (pid, nbrs) in neighbors.items())
+                    if agent_pool is not None:
+                        agent_pool.set_neighbors(neighbor_indices)
+                if stale:
+                    # A new list, so that views from earlier rounds don't change
+                    peer_info = list(peer_info)
+                    for pid in stale:
+                        peer_info[order[pid]] = PeerInfo(pid, available[pid])
+                    stale.clear()
+                requests = dict()  # peer_id -> list of Requests
+                uploads = dict()   # peer_id -> list of Uploads
+                h = dict()
+                skipped = () if everyone else synced
+                if agent_pool is not None:
+                    results = agent_pool.requests([(p.id, state.pieces(p.id))
+                                                   for p in peers
+                                                   if p.id not in skipped])
+                for p in peers:
+                    if p.id in skipped:
+                        requests[p.id] = []
+                        continue
+                    if agent_pool is not None:
+                        (rs, seconds) = results[p.id]
+                        requests[p.id] = checked_requests(p, rs, seconds, state)
+                    else:
+                        h[p.id] = history.peer_history(p.id)
+                        requests[p.id] = get_peer_requests(p, peer_info, h[p.id],
+                                                           state)
+                    if active_set and state.peer_done(p.id):
+                        synced.add(p.id)
+                timers.lap("requests")
+
+                requests_to = requests_by_target(requests)
+                idle = set(p.id for p in peers
+                           if (active_set and not everyone and not requests_to[p.id] and
+                               (state.peer_done(p.id) or not requests[p.id])))
+                if agent_pool is not None:
+                    results = agent_pool.uploads([(p.id, requests_to[p.id])
+                                                  for p in peers
+                                                  if p.id not in idle])
+                for p in peers:
+                    if p.id in idle:
+                        uploads[p.id] = []
+                        continue
+                    if agent_pool is not None:
+                        (us, seconds) = results[p.id]
+                        uploads[p.id] = checked_uploads(p, us, seconds)
+                        continue
+                    if p.id not in h:
+                        h[p.id] = history.peer_history(p.id)
+                    uploads[p.id] = get_peer_uploads(requests_to[p.id], p,
+                                                     peer_info, h[p.id])
+                timers.lap("uploads")
+
+                downloads = update_peer_pieces(state, requests, uploads, rarity)
+                timers.lap("update_peer_pieces")
+                history.update(downloads, uploads)
+                if agent_pool is not None:
+                    agent_pool.round_done(completed, downloads, uploads)
+                del completed[:]
+                timers.lap("history.update")
+
+                if log_debug:
+                    logging.debug(history.pretty_for_round(round))
+
+                log_peer_info(state)
+                timers.lap("logging")
+
+                done = all_done(state)
+                timers.lap("history.update")
+                if done:
+                    logging.info("All done!")
+                    break
+                round += 1
+                if round > conf.max_round:
+                    logging.info("Out of time.  Stopping.")
+                    break
+        finally:
+            if agent_pool is not None:
+                agent_pool.close()
+
+        if log_info:
+            logging.info("Game history:\n%s", history.pretty())
+
+            logging.info("======== STATS ========")
+            logging.info("Uploaded blocks:\n%s",
+                         Stats.uploaded_blocks_str(self.peer_ids, history))
+            logging.info("Completion rounds:\n%s",
+                         Stats.completion_rounds_str(self.peer_ids, history))
+            logging.info("All done round: %s",
+                         Stats.all_done_round(self.peer_ids, history))
+
+        if recorder is not None:
+            recorder.close()
         return history
 
     def run_sim(self):
-        histories = [self.run_sim_once() for i in range(self.config.iters)]
+        conf = self.config
+        # Every iteration gets its own seed, derived from --seed (or a random
+        # one), so iterations come out the same whichever process runs them.
+        seed = conf.seed
+        if seed is None:
+            seed = random.randrange(2**32)
+        seeds = ["%s:%d" % (seed, i) for i in range(conf.iters)]
+        if conf.record:
+            # Every iteration has to run to be recorded, so no cache
+            tasks = [(conf, seed, record_path(conf.record, i, conf.iters))
+                     for (i, seed) in enumerate(seeds)]
+            cache = None
+        else:
+            tasks = [(conf, seed) for seed in seeds]
+            # Only seeded runs can be reproduced, so only they are cached
+            cache = None
+            if conf.seed is not None and conf.cache_dir and cacheable(conf):
+                cache = ResultCache(conf.cache_dir, conf.cache_size)
+        summaries = run_iterations(tasks, conf.jobs, cache)
+        self.peer_ids = summaries[0]["peer_ids"]
+
         logging.warning("======== SUMMARY STATS ========")
         
-        uploaded_blocks = [Stats.uploaded_blocks(self.peer_ids, h) for h in histories]
-        completion_rounds = [Stats.completion_rounds(self.peer_ids, h) for h in histories]
+        uploaded_blocks = [s["uploaded_blocks"] for s in summaries]
+        completion_rounds = [s["completion_rounds"] for s in summaries]
 
         def extract_by_peer_id(lst, peer_id):
             """Given a list of dicts, pull out the entry
@@ -367,7 +817,7 @@ class Sim:
         for p_id in sorted(self.peer_ids,
                            key=lambda id: mean(uploaded_by_id[id])):
             us = uploaded_by_id[p_id]
-            logging.warning("%s: %.1f  (%.1f)" % (p_id, mean(us), stddev(us)))
+            logging.warning("%s: %.1f  (%.1f)", p_id, mean(us), stddev(us))
 
         logging.warning("Completion rounds: avg (stddev)")
 
@@ -382,20 +832,108 @@ class Sim:
         opt_mean = optionize(mean)
         opt_stddev = optionize(stddev)
         
-        for p_id in sorted(self.peer_ids,
-                           key=lambda id: opt_mean(completion_by_id[id])):
+        def by_completion(id):
+            # Peers that didn't always finish (None) go last
+            m = opt_mean(completion_by_id[id])
+            return (m is None, m or 0)
+
+        for p_id in sorted(self.peer_ids, key=by_completion):
             cs = completion_by_id[p_id]
-            logging.warning("%s: %s  (%s)" % (p_id, opt_mean(cs), opt_stddev(cs)))
+            logging.warning("%s: %s  (%s)", p_id, opt_mean(cs), opt_stddev(cs))
+
+        # Where the time went, summed over the iterations that were run
+        # rather than taken from the cache
+        run = [s for s in summaries if "phase_times" in s]
+        if len(run) < len(summaries):
+            logging.warning("%d of %d iterations were taken from the cache",
+                            len(summaries) - len(run), len(summaries))
+        if not run:
+            return
+        timers = PhaseTimers()
+        for s in run:
+            timers.merge(s["phase_times"])
+        logging.warning("Round loop phase times: seconds (share)")
+        for line in timers.report():
+            logging.warning(line)
+
+        latencies = CallLatencies()
+        for s in run:
+            latencies.merge(*s["call_latencies"])
+        logging.warning("Agent call latencies, slowest first:")
+        for line in latencies.report():
+            logging.warning(line)
+
+
+def run_iteration(config, seed, record=None):
+    """
+    Run one simulation seeded with seed (see Sim), recording it to the
+    path record if given, and return its Stats.summary().  Only the
+    summary is kept, not the history.  Lives at module level so that
+    worker processes can run it.
+    """
+    sim = Sim(config, seed=seed, record=record)
+    history = sim.run_sim_once()
+    summary = Stats.summary(sim.peer_ids, history)
+    summary["phase_times"] = dict(sim.phase_times.totals)
+    summary["call_latencies"] = (sim.call_latencies.samples,
+                                 sim.call_latencies.over_budget)
+    return summary
 
 
+def run_iterations(tasks, jobs, cache=None):
+    """
+    tasks: list of (config, seed) or (config, seed, record) -- the
+        arguments of run_iteration
+    jobs: number of worker processes to spread the tasks over
+    cache: a ResultCache, or None.  Tasks with a cached summary aren't
+        run, and the summaries of the ones that are get added to it.
+
+    Returns the summaries, in task order.  Summaries from the cache have
+    no phase_times or call_latencies.
+    """
+    summaries = [None] * len(tasks)
+    keys = [None] * len(tasks)
+    todo = []
+    for (n, task) in enumerate(tasks):
+        if cache is not None:
+            keys[n] = cache.key(*task[:2])
+            summaries[n] = cache.get(keys[n])
+        if summaries[n] is None:
+            todo.append(n)
+
+    if jobs > 1 and len(todo) > 1:
+        # Forked workers would inherit a running --profile; turn it off
+        pool = multiprocessing.Pool(min(jobs, len(todo)),
+                                    initializer=sys.setprofile,
+                                    initargs=(None,))
+        try:
+            results = pool.starmap(run_iteration, [tasks[n] for n in todo],
+                                   chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [run_iteration(*tasks[n]) for n in todo]
 
-def configure_logging(loglevel):
+    for (n, summary) in zip(todo, results):
+        summaries[n] = summary
+        if cache is not None:
+            cache.put(keys[n], summary)
+    if cache is not None and todo:
+        cache.evict()
+    return summaries
+
+
+def configure_logging(loglevel, stream=None):
+    """Log to stream, stdout by default"""
     numeric_level = getattr(logging, loglevel.upper(), None)
     if not isinstance(numeric_level, int):
         raise ValueError('Invalid log level: %s' % loglevel)
 
     root_logger = logging.getLogger('')
-    strm_out = logging.StreamHandler(sys.__stdout__)
+    if stream is None:
+        stream = sys.__stdout__
+    strm_out = logging.StreamHandler(stream)
 #    strm_out.setFormatter(logging.Formatter('%(levelno)s: %(message)s'))
     strm_out.setFormatter(logging.Formatter('%(message)s'))
     root_logger.setLevel(numeric_level)
@@ -422,6 +960,51 @@ def parse_agents(args):
     return ans
             
         
+def parse_trusted(arg):
+    """'DakzStd,Seed' -> frozenset(['DakzStd', 'Seed'])"""
+    return frozenset(name for name in arg.split(",") if name)
+
+
+# Settings that make_config fills in when they aren't given
+CONFIG_DEFAULTS = {
+    "jobs": 1,
+    "agent_jobs": 1,  # worker processes to run each round's agent calls in
+    "engine": "python",
+    "trusted_agents": frozenset(),  # agent class names to skip validation for
+    "time_budget": None,  # seconds allowed per requests() / uploads() call
+    "over_budget": "warn",  # or "drop": treat an over-budget result as []
+    "active_set": False,  # skip agents with nothing to do (see run_sim_once)
+    "seed": None,  # iterations are seeded from this (see run_sim)
+    "cache_dir": None,  # where to cache the results of seeded runs
+    "cache_size": 64 * 2**20,  # bytes the cache may take
+    "record": None,  # path to record each iteration's history to
+    "history_window": None,  # rounds of messages the History keeps
+    "tracker_k": None,  # neighbors per peer in tracker mode; None for all
+    "tracker_interval": 10,  # rounds between tracker announces
+}
+
+
+def make_config(agent_class_names, agent_classes, **settings):
+    """
+    Build the Params for a simulation.
+
+    agent_class_names: one class name per peer, as from parse_agents
+    agent_classes: dict : class_name -> class, as from load_modules.  May
+        hold more classes than are used.
+    settings: num_pieces, blocks_per_piece, max_round, min_up_bw,
+        max_up_bw and iters, plus any of CONFIG_DEFAULTS to override
+    """
+    config = Params()
+    config.add("agent_class_names", agent_class_names)
+    config.add("agent_classes", dict((name, agent_classes[name])
+                                     for name in set(agent_class_names)))
+    for key, value in settings.items():
+        config.add(key, value)
+    for key, value in CONFIG_DEFAULTS.items():
+        if key not in settings:
+            config.add(key, value)
+    return config
+
 
 def main(args):
     usage_msg = "Usage:  %prog [options] PeerClass1[,count] PeerClass2[,count] ..."
@@ -456,10 +1039,84 @@ def main(args):
                       dest="max_up_bw", default=10, type="int",
                       help="Max upload bandwidth")
 
+    parser.add_option("--engine",
+                      dest="engine", default="python",
+                      choices=sorted(ENGINES.keys()),
+                      help="How to store the swarm state: 'python' or 'numpy'")
+
     parser.add_option("--iters",
                       dest="iters", default=1, type="int",
                       help="Number of times to run simulation to get stats")
 
+    parser.add_option("--jobs",
+                      dest="jobs", default=1, type="int",
+                      help="Number of worker processes to spread iterations over")
+
+    parser.add_option("--agent-jobs",
+                      dest="agent_jobs", default=1, type="int",
+                      help="Number of worker processes to run each round's agent calls in, for large swarms.  Can't be combined with --jobs")
+
+    parser.add_option("--trusted-agents",
+                      dest="trusted_agents", default="",
+                      help="Comma-separated agent classes whose requests and uploads aren't validated")
+
+    parser.add_option("--time-budget",
+                      dest="time_budget", default=None, type="float",
+                      help="Seconds each agent's requests() or uploads() call may take")
+
+    parser.add_option("--over-budget",
+                      dest="over_budget", default="warn",
+                      choices=["warn", "drop"],
+                      help="What to do with a call over --time-budget: 'warn', or 'drop' its result")
+
+    parser.add_option("--seed",
+                      dest="seed", default=None, type="int",
+                      help="Seed for reproducible runs.  Each iteration and each peer gets its own random number generator derived from it")
+
+    parser.add_option("--cache-dir",
+                      dest="cache_dir", default=".simcache",
+                      help="Directory for the cache of seeded runs' results.  Not used with --loglevel info or debug, --profile, or --over-budget drop")
+
+    parser.add_option("--cache-size",
+                      dest="cache_size", default=64, type="int",
+                      help="Megabytes the result cache may take before old entries are evicted")
+
+    parser.add_option("--no-cache",
+                      dest="cache", default=True, action="store_false",
+                      help="Run every iteration even if its result is cached")
+
+    parser.add_option("--record",
+                      dest="record", default=None,
+                      help="Record each iteration's rounds to this gzipped JSON-lines file (with the iteration number added if --iters > 1)")
+
+    parser.add_option("--history-window",
+                      dest="history_window", default=None, type="int",
+                      help="Only keep the messages of about this many recent rounds in memory.  Agents can't look further back")
+
+    parser.add_option("--tracker-k",
+                      dest="tracker_k", default=None, type="int",
+                      help="Tracker mode: each peer only sees, and requests from, this many random neighbors")
+
+    parser.add_option("--tracker-interval",
+                      dest="tracker_interval", default=10, type="int",
+                      help="Rounds between tracker announces, when the neighbors are resampled")
+
+    parser.add_option("--active-set",
+                      dest="active_set", default=False, action="store_true",
+                      help="Don't call finished or idle agents that have nothing to do in a round")
+
+    def set_profile(option, opt_str, value, parser):
+        # The path is optional, so only take the next argument if it
+        # looks like a profile file rather than an agent class
+        path = "out.prof"
+        if parser.rargs and parser.rargs[0].endswith(".prof"):
+            path = parser.rargs.pop(0)
+        setattr(parser.values, option.dest, path)
+
+    parser.add_option("--profile",
+                      dest="profile", default=None,
+                      action="callback", callback=set_profile,
+                      help="Run under cProfile and write the stats to PATH.prof (default out.prof).  Only profiles this process, not --jobs workers")
 
     (options, args) = parser.parse_args()
 
@@ -475,26 +1132,51 @@ def main(args):
         except ValueError as e:
             usage(e)
     
-    configure_logging(options.loglevel)
-    config = Params()
-
-    config.add("agent_class_names", agents_to_run)
-    config.add("agent_classes", load_modules(config.agent_class_names))
+    if options.engine == "numpy" and np is None:
+        usage("--engine numpy needs numpy to be installed")
+    if options.history_window is not None and options.history_window < MIN_WINDOW:
+        usage("--history-window must be at least %d" % MIN_WINDOW)
+    if options.tracker_k is not None and options.tracker_k < 1:
+        usage("--tracker-k must be at least 1")
+    if options.tracker_interval < 1:
+        usage("--tracker-interval must be at least 1")
+    if options.agent_jobs < 1:
+        usage("--agent-jobs must be at least 1")
+    if options.agent_jobs > 1 and options.jobs > 1:
+        # The --jobs workers are daemons, which can't start processes
+        usage("Use either --jobs or --agent-jobs, not both")
 
-    
-    config.add("num_pieces", options.num_pieces)
-    config.add("blocks_per_piece",options.blocks_per_piece)
-    config.add("max_round", options.max_round)
-    config.add("min_up_bw", options.min_up_bw)
-    config.add("max_up_bw", options.max_up_bw)
-    config.add("iters", options.iters)
+    configure_logging(options.loglevel)
+    config = make_config(agents_to_run, load_modules(agents_to_run),
+                         num_pieces=options.num_pieces,
+                         blocks_per_piece=options.blocks_per_piece,
+                         max_round=options.max_round,
+                         min_up_bw=options.min_up_bw,
+                         max_up_bw=options.max_up_bw,
+                         iters=options.iters,
+                         jobs=options.jobs,
+                         agent_jobs=options.agent_jobs,
+                         engine=options.engine,
+                         trusted_agents=parse_trusted(options.trusted_agents),
+                         time_budget=options.time_budget,
+                         over_budget=options.over_budget,
+                         active_set=options.active_set,
+                         seed=options.seed,
+                         cache_dir=options.cache_dir if options.cache else None,
+                         cache_size=options.cache_size * 2**20,
+                         record=options.record,
+                         history_window=options.history_window,
+                         tracker_k=options.tracker_k,
+                         tracker_interval=options.tracker_interval)
     
     sim = Sim(config)
-    sim.run_sim()
+    if options.profile:
+        import cProfile
+        cProfile.runctx("sim.run_sim()", globals(), {"sim": sim},
+                        options.profile)
+        logging.warning("Wrote profile to %s", options.profile)
+    else:
+        sim.run_sim()
 
 if __name__ == "__main__":
-
-    # The next two lines are for profiling...
-    import cProfile
-    cProfile.run('main(sys.argv)', 'out.prof')
-#    main(sys.argv)
+    main(sys.argv)
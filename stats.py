@@ -10,13 +10,8 @@ class Stats:
         Returns:
         dict: peer_id -> total upload blocks used
         """
-        uploaded = dict((peer_id, 0) for peer_id in peer_ids)
-        for peer_id in peer_ids:
-            for ds in history.downloads[peer_id]:
-                for download in ds:
-                    uploaded[download.from_id] += download.blocks
-                
-        return uploaded
+        uploaded = history.uploaded_blocks()
+        return dict((peer_id, uploaded[peer_id]) for peer_id in peer_ids)
 
     @staticmethod
     def uploaded_blocks_str(peer_ids, history):
@@ -43,9 +38,40 @@ class Stats:
         """ Return a pretty stringified version of completion_rounds """
         d = Stats.completion_rounds(peer_ids, history)
 
-        k = lambda id: d[id]
+        # Peers that never finished (None) go last
+        k = lambda id: (d[id] is None, d[id] or 0)
         return "\n".join("%s: %s" % (id, d[id])
-                         for id in sorted(list(d.keys()), key=d.__getitem__))
+                         for id in sorted(list(d.keys()), key=k))
+
+    @staticmethod
+    def downloaded_blocks(peer_ids, history):
+        """dict: peer_id -> total blocks downloaded"""
+        return dict((peer_id, history.downloaded[peer_id]) for peer_id in peer_ids)
+
+    @staticmethod
+    def round_totals(history):
+        """
+        Returns a list with one (blocks downloaded, upload bw offered) pair
+        per round played so far.
+        """
+        return list(zip(history.round_blocks, history.round_bw))
+
+    @staticmethod
+    def summary(peer_ids, history):
+        """
+        Compact, picklable stats for one run -- everything run_sim needs
+        for the summary, without the history itself.  O(peers), and safe to
+        call in the middle of a run for live numbers.
+
+        Returns dict with keys peer_ids, rounds, uploaded_blocks,
+        downloaded_blocks, completion_rounds and all_done_round.
+        """
+        return {"peer_ids": list(peer_ids),
+                "rounds": history.num_rounds,
+                "uploaded_blocks": Stats.uploaded_blocks(peer_ids, history),
+                "downloaded_blocks": Stats.downloaded_blocks(peer_ids, history),
+                "completion_rounds": Stats.completion_rounds(peer_ids, history),
+                "all_done_round": Stats.all_done_round(peer_ids, history)}
 
     @staticmethod
     def all_done_round(peer_ids, history):
@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+
+"""
+Runs the simulation over a grid of parameters in one process (or one pool of
+worker processes) and writes a single results table.
+
+Every combination of the --num-pieces, --blocks-per-piece, --min-bw,
+--max-bw, --max-round and --agents values is one point of the sweep.  Each
+point is run --iters times.  The table has one row per point and agent
+class, with the completion round and upload stats of that class's peers.
+"""
+
+import sys
+import csv
+import contextlib
+import random
+import logging
+import itertools
+from optparse import OptionParser
+
+from sim import (ENGINES, np, make_config, parse_agents, parse_trusted,
+                 configure_logging, run_iterations)
+from cache import ResultCache, cacheable
+from history import MIN_WINDOW
+from util import load_modules, mean, stddev
+
+
+COLUMNS = ["num_pieces", "blocks_per_piece", "min_up_bw", "max_up_bw",
+           "max_round", "agents", "agent_class", "peers", "iters",
+           "done_frac", "completion_mean", "completion_stddev",
+           "uploaded_mean", "uploaded_stddev", "all_done_mean"]
+
+
+def parse_ints(s):
+    """'10,20,40' -> [10, 20, 40]"""
+    return [int(v) for v in s.split(",")]
+
+
+def sweep_points(options, agent_specs):
+    """
+    Returns a list of dicts, one per point of the grid.  Points with
+    min_up_bw > max_up_bw are skipped.
+    """
+    grid = itertools.product(parse_ints(options.num_pieces),
+                             parse_ints(options.blocks_per_piece),
+                             parse_ints(options.min_up_bw),
+                             parse_ints(options.max_up_bw),
+                             parse_ints(options.max_round),
+                             agent_specs)
+    points = []
+    for (num_pieces, bpp, min_bw, max_bw, max_round, agents) in grid:
+        if min_bw > max_bw:
+            continue
+        points.append({"num_pieces": num_pieces,
+                       "blocks_per_piece": bpp,
+                       "min_up_bw": min_bw,
+                       "max_up_bw": max_bw,
+                       "max_round": max_round,
+                       "agents": agents})
+    return points
+
+
+def point_rows(point, agent_class_names, summaries):
+    """
+    Collapse the summaries of all the iterations of one point into one
+    table row per agent class.
+    """
+    def fmt(x):
+        if x is None:
+            return "-"
+        return "%.2f" % x
+
+    all_done = [s["all_done_round"] for s in summaries
+                if s["all_done_round"] is not None]
+    rows = []
+    for class_name in sorted(set(agent_class_names)):
+        completions = []
+        uploads = []
+        for s in summaries:
+            # peer ids are created in agent_class_names order
+            for (p_id, name) in zip(s["peer_ids"], agent_class_names):
+                if name != class_name:
+                    continue
+                uploads.append(s["uploaded_blocks"][p_id])
+                completions.append(s["completion_rounds"][p_id])
+        peers = agent_class_names.count(class_name)
+        finished = [c for c in completions if c is not None]
+
+        row = dict(point)
+        row.update({
+            "agents": " ".join(row["agents"]),
+            "agent_class": class_name,
+            "peers": peers,
+            "iters": len(summaries),
+            "done_frac": fmt(len(finished) / float(len(completions))),
+            "completion_mean": fmt(mean(finished) if finished else None),
+            "completion_stddev": fmt(stddev(finished) if finished else None),
+            "uploaded_mean": fmt(mean(uploads)),
+            "uploaded_stddev": fmt(stddev(uploads)),
+            "all_done_mean": fmt(mean(all_done) if all_done else None)})
+        rows.append(row)
+    return rows
+
+
+def run_sweep(points, agent_classes, options):
+    """
+    Run every iteration of every point, spread over options.jobs worker
+    processes.  Returns the table rows.
+    """
+    configs = []
+    for point in points:
+        names = parse_agents(point["agents"])
+        configs.append(make_config(names, agent_classes,
+                                   num_pieces=point["num_pieces"],
+                                   blocks_per_piece=point["blocks_per_piece"],
+                                   max_round=point["max_round"],
+                                   min_up_bw=point["min_up_bw"],
+                                   max_up_bw=point["max_up_bw"],
+                                   iters=options.iters,
+                                   engine=options.engine,
+                                   trusted_agents=parse_trusted(options.trusted_agents),
+                                   time_budget=options.time_budget,
+                                   over_budget=options.over_budget,
+                                   active_set=options.active_set,
+                                   history_window=options.history_window,
+                                   tracker_k=options.tracker_k,
+                                   tracker_interval=options.tracker_interval))
+
+    # One task per iteration of every point, so that the pool stays busy
+    # even when points differ a lot in cost.
+    seed = options.seed
+    if seed is None:
+        seed = random.randrange(2**32)
+    # Iteration i of every point is seeded the same as iteration i of
+    # sim.py --seed, so a point's results don't depend on the rest of the
+    # grid (and cached results stay valid when the grid changes).
+    tasks = [(config, "%s:%d" % (seed, i))
+             for config in configs
+             for i in range(options.iters)]
+    # Only seeded sweeps can be reproduced, so only they are cached
+    cache = None
+    if (options.seed is not None and options.cache and
+            all(cacheable(config) for config in configs)):
+        cache = ResultCache(options.cache_dir, options.cache_size * 2**20)
+    summaries = run_iterations(tasks, options.jobs, cache)
+
+    rows = []
+    for (n, (point, config)) in enumerate(zip(points, configs)):
+        mine = summaries[n * options.iters:(n + 1) * options.iters]
+        rows.extend(point_rows(point, config.agent_class_names, mine))
+    return rows
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options] --agents 'PeerClass1[,count] ...' [--agents ...]"
+    parser = OptionParser(usage=usage_msg)
+
+    def usage(msg):
+        print(("Error: %s\n" % msg))
+        parser.print_help()
+        sys.exit()
+
+    parser.add_option("--loglevel",
+                      dest="loglevel", default="warning",
+                      help="Set the logging level: 'debug' or 'info'")
+
+    parser.add_option("--num-pieces",
+                      dest="num_pieces", default="3",
+                      help="Comma-separated numbers of pieces in the file")
+
+    parser.add_option("--blocks-per-piece",
+                      dest="blocks_per_piece", default="4",
+                      help="Comma-separated numbers of blocks per piece")
+
+    parser.add_option("--max-round",
+                      dest="max_round", default="5",
+                      help="Comma-separated limits on the number of rounds")
+
+    parser.add_option("--min-bw",
+                      dest="min_up_bw", default="4",
+                      help="Comma-separated min upload bandwidths")
+
+    parser.add_option("--max-bw",
+                      dest="max_up_bw", default="10",
+                      help="Comma-separated max upload bandwidths")
+
+    parser.add_option("--agents",
+                      dest="agents", action="append", default=[],
+                      help="One agent mix, like 'DakzStd,4 Seed,2'.  Repeat for more mixes")
+
+    parser.add_option("--engine",
+                      dest="engine", default="python",
+                      choices=sorted(ENGINES.keys()),
+                      help="How to store the swarm state: 'python' or 'numpy'")
+
+    parser.add_option("--trusted-agents",
+                      dest="trusted_agents", default="",
+                      help="Comma-separated agent classes whose requests and uploads aren't validated")
+
+    parser.add_option("--time-budget",
+                      dest="time_budget", default=None, type="float",
+                      help="Seconds each agent's requests() or uploads() call may take")
+
+    parser.add_option("--over-budget",
+                      dest="over_budget", default="warn",
+                      choices=["warn", "drop"],
+                      help="What to do with a call over --time-budget: 'warn', or 'drop' its result")
+
+    parser.add_option("--history-window",
+                      dest="history_window", default=None, type="int",
+                      help="Only keep the messages of about this many recent rounds in memory.  Agents can't look further back")
+
+    parser.add_option("--tracker-k",
+                      dest="tracker_k", default=None, type="int",
+                      help="Tracker mode: each peer only sees, and requests from, this many random neighbors")
+
+    parser.add_option("--tracker-interval",
+                      dest="tracker_interval", default=10, type="int",
+                      help="Rounds between tracker announces, when the neighbors are resampled")
+
+    parser.add_option("--active-set",
+                      dest="active_set", default=False, action="store_true",
+                      help="Don't call finished or idle agents that have nothing to do in a round")
+
+    parser.add_option("--seed",
+                      dest="seed", default=None, type="int",
+                      help="Seed for reproducible sweeps.  Each iteration of each point gets its own seed derived from it")
+
+    parser.add_option("--cache-dir",
+                      dest="cache_dir", default=".simcache",
+                      help="Directory for the cache of seeded runs' results.  Not used with --loglevel info or debug, or --over-budget drop")
+
+    parser.add_option("--cache-size",
+                      dest="cache_size", default=64, type="int",
+                      help="Megabytes the result cache may take before old entries are evicted")
+
+    parser.add_option("--no-cache",
+                      dest="cache", default=True, action="store_false",
+                      help="Run every iteration even if its result is cached")
+
+    parser.add_option("--iters",
+                      dest="iters", default=1, type="int",
+                      help="Number of times to run each point")
+
+    parser.add_option("--jobs",
+                      dest="jobs", default=1, type="int",
+                      help="Number of worker processes")
+
+    parser.add_option("--out",
+                      dest="out", default="sweep.tsv",
+                      help="Where to write the results table ('-' for stdout)")
+
+    (options, args) = parser.parse_args()
+
+    specs = options.agents or ["Dummy,2 Seed"]
+    try:
+        agent_specs = [spec.split() for spec in specs]
+        names = set()
+        for spec in agent_specs:
+            names.update(parse_agents(spec))
+        points = sweep_points(options, agent_specs)
+    except ValueError as e:
+        usage(e)
+
+    if options.engine == "numpy" and np is None:
+        usage("--engine numpy needs numpy to be installed")
+    if options.history_window is not None and options.history_window < MIN_WINDOW:
+        usage("--history-window must be at least %d" % MIN_WINDOW)
+
+    # With --out - stdout is the table, so everything else goes to stderr
+    log_stream = sys.stderr if options.out == "-" else None
+    configure_logging(options.loglevel, log_stream)
+    # Load every agent module once, up front, for all the points
+    agent_classes = load_modules(sorted(names))
+
+    logging.warning("Sweeping %d points, %d iterations each" % (
+        len(points), options.iters))
+    # Keep the agents' prints out of the table.  Forked workers inherit
+    # the redirection.
+    with contextlib.redirect_stdout(sys.stderr):
+        rows = run_sweep(points, agent_classes, options)
+
+    if options.out == "-":
+        out = sys.stdout
+    else:
+        out = open(options.out, "w", newline="")
+    try:
+        writer = csv.DictWriter(out, COLUMNS, delimiter="\t")
+        writer.writeheader()
+        writer.writerows(rows)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    logging.warning("Wrote %d rows to %s" % (len(rows), options.out))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+import math
+import time
+from array import array
+
+
+class PhaseTimers:
+    """
+    Wall-clock time spent in each phase of the sim's round loop, summed over
+    rounds (and over runs, with merge()).
+
+    totals: dict : phase name -> seconds
+
+    The round loop calls lap(phase) at the end of each phase, which charges
+    everything since the previous lap to that phase.  Time measured inside a
+    lap with add() -- validation inside the request phase, say -- is charged
+    to its own phase instead.
+    """
+    PHASES = ["requests", "validation", "uploads", "update_peer_pieces",
+              "history.update", "logging"]
+
+    def __init__(self):
+        self.totals = dict((phase, 0.0) for phase in self.PHASES)
+        self._last = time.perf_counter()
+        self._nested = 0.0
+
+    def start(self):
+        """Start the first lap now"""
+        self._last = time.perf_counter()
+        self._nested = 0.0
+
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.totals[phase] += now - self._last - self._nested
+        self._last = now
+        self._nested = 0.0
+
+    def add(self, phase, seconds):
+        """Charge seconds that were measured inside the current lap to phase"""
+        self.totals[phase] += seconds
+        self._nested += seconds
+
+    def merge(self, totals):
+        """Add in the totals dict of another PhaseTimers"""
+        for (phase, seconds) in totals.items():
+            self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+
+    def report(self):
+        """List of 'phase: seconds (share of the total)' lines"""
+        total = sum(self.totals.values())
+        lines = []
+        for phase in self.PHASES:
+            seconds = self.totals[phase]
+            share = 100.0 * seconds / total if total > 0 else 0.0
+            lines.append("%s: %.3fs  (%.1f%%)" % (phase, seconds, share))
+        return lines
+
+
+class CallLatencies:
+    """
+    How long each agent's requests() and uploads() calls took, grouped by
+    agent class.
+
+    samples: dict : (class name, method name) -> array of seconds, one per call
+    over_budget: dict : (class name, method name) -> number of calls that
+        went over the time budget
+    """
+    def __init__(self):
+        self.samples = dict()
+        self.over_budget = dict()
+
+    def add(self, class_name, method, seconds):
+        key = (class_name, method)
+        if key not in self.samples:
+            self.samples[key] = array('d')
+        self.samples[key].append(seconds)
+
+    def add_over_budget(self, class_name, method):
+        key = (class_name, method)
+        self.over_budget[key] = self.over_budget.get(key, 0) + 1
+
+    def merge(self, samples, over_budget):
+        """Add in the samples and over_budget dicts of another CallLatencies"""
+        for (key, seconds) in samples.items():
+            if key not in self.samples:
+                self.samples[key] = array('d')
+            self.samples[key].extend(seconds)
+        for (key, n) in over_budget.items():
+            self.over_budget[key] = self.over_budget.get(key, 0) + n
+
+    def report(self):
+        """List of 'Class.method: calls, p50, p95, max' lines, slowest first"""
+        def percentile(values, q):
+            # nearest rank on sorted values
+            return values[max(0, int(math.ceil(q * len(values))) - 1)]
+
+        rows = []
+        for (key, seconds) in self.samples.items():
+            values = sorted(seconds)
+            rows.append((values[-1], key, values))
+        lines = []
+        for (worst, (class_name, method), values) in sorted(rows, reverse=True):
+            line = "%s.%s: %d calls, p50 %.2fms, p95 %.2fms, max %.2fms" % (
+                class_name, method, len(values),
+                1000 * percentile(values, 0.5),
+                1000 * percentile(values, 0.95),
+                1000 * worst)
+            over = self.over_budget.get((class_name, method), 0)
+            if over:
+                line += ", %d over budget" % over
+            lines.append(line)
+        return lines
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+
+"""
+A long-lived simulation worker, for running many short sims without paying
+for python startup, imports and agent loading every time.
+
+The worker reads requests, one JSON object per line, from stdin (or from
+connections to a Unix socket, with --socket) and answers each with one
+JSON line.  A request looks like
+
+    {"id": 7, "agents": ["DakzStd,4", "Seed"], "num_pieces": 20,
+     "max_round": 100, "seed": 1, "iters": 2}
+
+"agents" is required; the other settings default as for sim.py, and any
+of sim.py's CONFIG_DEFAULTS can be given too, except the ones in
+NOT_SETTABLE (trusted_agents as a list).  The answer echoes the id:
+
+    {"id": 7, "ok": true, "summaries": [...]}   -- one per iteration
+    {"id": 7, "ok": false, "error": "..."}
+
+Agent modules stay loaded between requests and are reloaded only when
+their file changes.  Anything the agents print goes to stderr, as does
+logging, so stdout only carries answers.
+
+WorkerPool starts several workers and keeps them all busy:
+
+    with WorkerPool(4) as pool:
+        answers = pool.run(requests)
+"""
+
+import os
+import io
+import sys
+import json
+import random
+import logging
+import importlib
+import selectors
+import contextlib
+import socketserver
+import subprocess
+from optparse import OptionParser
+
+from sim import CONFIG_DEFAULTS, make_config, parse_agents, run_iteration
+from cache import RESULT_KEYS
+from history import MIN_WINDOW
+
+
+# The settings make_config needs, with sim.py's defaults for them.  The
+# rest default through CONFIG_DEFAULTS.
+REQUEST_DEFAULTS = {
+    "num_pieces": 3,
+    "blocks_per_piece": 4,
+    "max_round": 5,
+    "min_up_bw": 4,
+    "max_up_bw": 10,
+    "iters": 1,
+}
+
+# CONFIG_DEFAULTS a request can't set: the worker runs the iterations
+# itself, doesn't cache or record them, and takes the seed separately
+NOT_SETTABLE = frozenset(["jobs", "seed", "cache_dir", "cache_size", "record"])
+
+# Settings a request may give
+SETTINGS = (frozenset(REQUEST_DEFAULTS) |
+            frozenset(CONFIG_DEFAULTS)) - NOT_SETTABLE
+
+
+class AgentLoader:
+    """
+    Agent classes by name, imported once and reloaded only when their
+    module's file changes.
+    """
+    def __init__(self):
+        self.mtimes = dict()  # module name -> mtime of the file when loaded
+
+    def classes(self, class_names):
+        """dict : class_name -> class, as load_modules"""
+        loaded = dict()
+        for name in set(class_names):
+            module_name = name.lower()  # as in load_modules
+            module = sys.modules.get(module_name)
+            if module is None:
+                module = importlib.import_module(module_name)
+            mtime = os.stat(module.__file__).st_mtime_ns
+            if module_name not in self.mtimes:
+                self.mtimes[module_name] = mtime
+            elif mtime != self.mtimes[module_name]:
+                logging.warning("Reloading %s", module_name)
+                module = importlib.reload(module)
+                self.mtimes[module_name] = mtime
+            loaded[name] = getattr(module, name)
+        return loaded
+
+
+def handle(request, loader):
+    """Run one request.  Returns the answer dict."""
+    unknown = set(request) - SETTINGS - set(["id", "agents", "seed"])
+    if unknown:
+        raise ValueError("Unknown settings: %s" % ", ".join(sorted(unknown)))
+    if "agents" not in request:
+        raise ValueError("No agents given")
+    names = parse_agents(request["agents"])
+    settings = dict(REQUEST_DEFAULTS)
+    settings.update((k, v) for (k, v) in request.items() if k in SETTINGS)
+    if "trusted_agents" in settings:
+        settings["trusted_agents"] = frozenset(settings["trusted_agents"])
+    window = settings.get("history_window")
+    if window is not None and window < MIN_WINDOW:
+        raise ValueError("history_window must be at least %d" % MIN_WINDOW)
+    seed = request.get("seed")
+    config = make_config(names, loader.classes(names), seed=seed, **settings)
+
+    # Seeded the same way as sim.py --seed
+    if seed is None:
+        seed = random.randrange(2**32)
+    summaries = []
+    for i in range(config.iters):
+        summary = run_iteration(config, "%s:%d" % (seed, i))
+        answer = dict((k, summary[k]) for k in RESULT_KEYS)
+        answer["phase_times"] = summary["phase_times"]
+        summaries.append(answer)
+    return {"ok": True, "summaries": summaries}
+
+
+def serve(infile, outfile, loader):
+    """Answer the requests on infile, one line each, until it closes"""
+    for line in infile:
+        if not line.strip():
+            continue
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            # Keep the agents' prints out of the answers
+            with contextlib.redirect_stdout(sys.stderr):
+                answer = handle(request, loader)
+        except Exception as e:
+            logging.exception("Request failed")
+            answer = {"ok": False, "error": "%s: %s" % (type(e).__name__, e)}
+        answer["id"] = request_id
+        outfile.write(json.dumps(answer) + "\n")
+        outfile.flush()
+
+
+def serve_socket(path, loader):
+    """Answer requests on a Unix socket, one connection at a time"""
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            infile = io.TextIOWrapper(self.rfile, encoding="utf-8")
+            outfile = io.TextIOWrapper(self.wfile, encoding="utf-8",
+                                       write_through=True)
+            serve(infile, outfile, loader)
+
+    if os.path.exists(path):
+        os.remove(path)
+    server = socketserver.UnixStreamServer(path, Handler)
+    logging.warning("Listening on %s", path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+
+
+class WorkerPool:
+    """
+    n worker processes, talked to over their stdin and stdout.
+    """
+    def __init__(self, n, loglevel="warning"):
+        worker = os.path.abspath(__file__)
+        self.procs = [subprocess.Popen(
+                          [sys.executable, worker, "--loglevel", loglevel],
+                          stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                          text=True, cwd=os.path.dirname(worker))
+                      for i in range(n)]
+
+    def run(self, requests):
+        """
+        Send each request (a dict, as for the worker) to the next free
+        worker.  Returns the answers, in request order.
+        """
+        answers = [None] * len(requests)
+        todo = list(range(len(requests)))
+        todo.reverse()
+        selector = selectors.DefaultSelector()
+        busy = set()
+
+        def send(proc):
+            n = todo.pop()
+            proc.stdin.write(json.dumps(dict(requests[n], id=n)) + "\n")
+            proc.stdin.flush()
+            busy.add(proc)
+
+        for proc in self.procs:
+            selector.register(proc.stdout, selectors.EVENT_READ, proc)
+            if todo:
+                send(proc)
+        try:
+            while busy:
+                for (key, events) in selector.select():
+                    proc = key.data
+                    # Each worker has one request out at a time, so there
+                    # is exactly one answer line to read
+                    line = proc.stdout.readline()
+                    if not line:
+                        raise RuntimeError("Worker %d exited" % proc.pid)
+                    answer = json.loads(line)
+                    answers[answer["id"]] = answer
+                    busy.discard(proc)
+                    if todo:
+                        send(proc)
+        finally:
+            selector.close()
+        return answers
+
+    def close(self):
+        for proc in self.procs:
+            proc.stdin.close()
+        for proc in self.procs:
+            proc.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def main(args):
+    usage_msg = "Usage:  %prog [options]"
+    parser = OptionParser(usage=usage_msg)
+
+    parser.add_option("--loglevel",
+                      dest="loglevel", default="warning",
+                      help="Set the logging level: 'debug' or 'info'")
+
+    parser.add_option("--socket",
+                      dest="socket", default=None,
+                      help="Listen on this Unix socket instead of reading stdin")
+
+    (options, args) = parser.parse_args()
+
+    logging.basicConfig(stream=sys.stderr, format="%(message)s",
+                        level=getattr(logging, options.loglevel.upper()))
+    loader = AgentLoader()
+    if options.socket:
+        serve_socket(options.socket, loader)
+    else:
+        serve(sys.stdin, sys.stdout, loader)
+
+
+if __name__ == "__main__":
+    main(sys.argv)